@@ -0,0 +1,169 @@
+from collections import OrderedDict
+from config import *
+from datetime import date
+import hashlib
+import io
+import json
+import math
+import re
+import threading
+import polars as pl
+from polars import col as c
+from calc import ALL_VALUE, filter_predicate, mc_diff, mc_diff_per_rx
+from cube import data_version, load_cube
+from execution import collect
+from metrics import Counter, register
+from query import FILTER_ARGS, LIST_ARGS, TOGGLE_ARGS, canonical_filters, filter_key
+
+KPI_MEASURES = ['total', 'mc_total', 'rx_ct']
+KPI_COLUMNS = KPI_MEASURES + ['mc_diff', 'per_rx', 'diff_pct']
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.file'
+ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+API_SCENARIOS = register(Counter('api_kpi_scenarios_total', 'Scenarios answered by the KPI API, by cache result.'))
+
+
+class ScenarioError(ValueError):
+    pass
+
+
+def parse_scenario(spec) -> tuple[str | None, dict]:
+    # same parameters as filter_data, plus an optional caller-chosen id echoed back in the results
+    if not isinstance(spec, dict):
+        raise ScenarioError('a scenario must be an object of filter_data parameters')
+    unknown = sorted(set(spec) - set(FILTER_ARGS) - {'id'})
+    if unknown:
+        raise ScenarioError(f'unknown parameters: {", ".join(unknown)}')
+    for arg in LIST_ARGS:
+        if spec.get(arg) is not None and not isinstance(spec[arg], list):
+            raise ScenarioError(f'{arg} must be a list')
+        # the names are matched against string columns; anything else would fail inside polars
+        if spec.get(arg) and not all(isinstance(value, str) and value for value in spec[arg]):
+            raise ScenarioError(f'{arg} must be a list of non-empty strings')
+    for arg in TOGGLE_ARGS:
+        # as_bool would read any other string as false
+        value = spec.get(arg)
+        if value is not None and not isinstance(value, bool) and value not in (ALL_VALUE, 'true', 'false'):
+            raise ScenarioError(f"{arg} must be 'All', true or false")
+    if (spec.get('date_start') is None) != (spec.get('date_end') is None):
+        raise ScenarioError('date_start and date_end must be given together')
+    for arg in ('date_start', 'date_end'):
+        value = spec.get(arg)
+        if value is not None:
+            # YYYY-MM-DD exactly: the filters slice the first ten characters and split them on '-', so
+            # numbers and the compact form fromisoformat also accepts would fail further down
+            if not isinstance(value, str) or not ISO_DATE.match(value):
+                raise ScenarioError(f'{arg} must be an ISO date string (YYYY-MM-DD)')
+            try:
+                date.fromisoformat(value[:10])
+            except ValueError:
+                raise ScenarioError(f'{arg} must be an ISO date string (YYYY-MM-DD)')
+    return spec.get('id'), canonical_filters(**{arg: spec.get(arg) for arg in FILTER_ARGS})
+
+
+def scenario_kpis(states: list[dict]) -> list[dict]:
+    # one pass over the cube for any number of scenarios: every scenario's sums only take the rows its
+    # predicate tags, and all of them are aggregated in the same select. Conditional sums rather than
+    # exploding rows per scenario, so memory doesn't grow with how much the scenarios overlap.
+    cube = load_cube()
+    sums = [c(measure).filter(filter_predicate(**state)).sum().alias(f'{measure}_{index}')
+            for index, state in enumerate(states) for measure in KPI_MEASURES]
+    row = collect(cube.lazy().select(sums), cube.estimated_size()).row(0, named=True)
+    totals = pl.DataFrame({measure: [row[f'{measure}_{index}'] for index in range(len(states))]
+                           for measure in KPI_MEASURES}, schema={'total': pl.Float64, 'mc_total': pl.Float64,
+                                                                 'rx_ct': pl.UInt64})
+    kpis = totals.with_columns(mc_diff()).with_columns(mc_diff_per_rx()).with_columns((c.mc_diff / c.total).alias('diff_pct'))
+    return kpis.to_dicts()
+
+
+class KpiCache:
+    # per-scenario results by data version and filter hash, so a model re-asking for mostly the same
+    # scenarios only computes the new ones
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, kpis: dict):
+        with self._lock:
+            self._entries[key] = kpis
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+KPI_CACHE = KpiCache(API_CACHE_MAX_ENTRIES)
+
+
+def kpis_for(states: list[dict]) -> list[dict]:
+    version = data_version()
+    keys = [(version, filter_key(**state)) for state in states]
+    results = [KPI_CACHE.get(key) for key in keys]
+    missing = {key: state for key, state, result in zip(keys, states, results) if result is None}
+    API_SCENARIOS.inc(len(states) - len(missing), result='hit')
+    API_SCENARIOS.inc(len(missing), result='miss')
+    if missing:
+        computed = dict(zip(missing, scenario_kpis(list(missing.values()))))
+        for key, kpis in computed.items():
+            KPI_CACHE.put(key, kpis)
+        results = [computed[key] if result is None else result for key, result in zip(keys, results)]
+    return results
+
+
+def finite(value):
+    # empty scenarios divide by zero; JSON has no NaN or infinity
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def register_api(server):
+    from flask import request
+
+    @server.route('/api/kpis', methods=['GET', 'POST'])
+    def kpis():
+        # GET takes one scenario as query parameters (repeat list parameters); POST takes a scenario
+        # object, a list of them, or {"scenarios": [...]}
+        if request.method == 'POST':
+            body = request.get_json(silent=True)
+            specs = body.get('scenarios', [body]) if isinstance(body, dict) else body
+        else:
+            specs = [{arg: request.args.getlist(arg) if arg in LIST_ARGS else request.args.get(arg)
+                      for arg in FILTER_ARGS if arg in request.args}]
+        if not isinstance(specs, list) or not specs:
+            return {'error': 'expected one or more scenarios'}, 400
+        if len(specs) > API_MAX_SCENARIOS:
+            return {'error': f'at most {API_MAX_SCENARIOS} scenarios per request'}, 400
+        try:
+            parsed = [parse_scenario(spec) for spec in specs]
+        except ScenarioError as error:
+            return {'error': str(error)}, 400
+
+        states = [state for _, state in parsed]
+        results = kpis_for(states)
+        arrow = request.args.get('format') == 'arrow' or request.accept_mimetypes.best == ARROW_MIMETYPE
+        if arrow:
+            frame = pl.DataFrame({
+                'id': [None if scenario_id is None else str(scenario_id) for scenario_id, _ in parsed],
+                'filters': [json.dumps(state) for state in states],
+                **{column: [result[column] for result in results] for column in KPI_COLUMNS},
+            })
+            buffer = io.BytesIO()
+            frame.write_ipc(buffer)
+            response = server.response_class(buffer.getvalue(), mimetype=ARROW_MIMETYPE)
+        else:
+            body = {'data_version': data_version(), 'results': [
+                {'id': scenario_id, 'filters': state, **{column: finite(result[column]) for column in KPI_COLUMNS}}
+                for (scenario_id, state), result in zip(parsed, results)
+            ]}
+            response = server.response_class(json.dumps(body), mimetype='application/json')
+        # the same scenarios against the same data always give the same answer
+        tag = json.dumps([data_version(), arrow, [[scenario_id, filter_key(**state)] for scenario_id, state in parsed]],
+                         default=str)
+        response.set_etag(hashlib.sha1(tag.encode()).hexdigest())
+        return response.make_conditional(request)
@@ -1,21 +1,51 @@
-from dash import Dash, html, dcc, callback, Output, Input, State
+import time
+imports_started = time.perf_counter()
+from dash import Dash, html, dcc, callback, clientside_callback, ClientsideFunction, ctx, no_update, Output, Input, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from config import *
 from calc import *
 from fig import *
+from query import filter_key
+from cube import load_cube, data_version
+from facets import facet_options
+from registry import load_registry
+from scheduler import SCHEDULER, Superseded
+from engine import FIGURE_CACHE, dashboard_view, view_etag
+from metrics import instrument, register_metrics
+from api import register_api
+from crossfilter import crossfilter_view, slice_filters
+from sampling import estimate_kpis
 import polars as pl
 from polars import col as c
 from datetime import date
+import os
+import uuid
+from startup import log_startup, record_phase, startup_phase, startup_report, warm_up
+record_phase('imports', time.perf_counter() - imports_started)
 
 
 app = Dash(__name__,external_stylesheets=[dbc.themes.BOOTSTRAP,dbc.icons.BOOTSTRAP,dbc.icons.FONT_AWESOME],assets_folder='assets')
 server = app.server
+register_metrics(server)
+register_api(server)
+with startup_phase('cube'):
+    load_cube()
+with startup_phase('registry'):
+    registry = load_registry()
+CLIENT_CROSSFILTER = CROSSFILTER_MODE == 'client'
+PROGRESSIVE = PROGRESSIVE_MODE and not CLIENT_CROSSFILTER
 
-def kpi_card(name,value,text_color):
+@server.route('/healthz')
+def healthz():
+    return {'data_version': data_version(), 'pid': os.getpid(), 'startup': startup_report()}
+
+def kpi_card(name,value,text_color,value_id=None,note=None):
     return dbc.Col(
     dbc.Card(
     dbc.CardBody([
-        html.H3(value,className="fw-bold text-center",style={'color':text_color}),
+        html.H3(value,className="fw-bold text-center",style={'color':text_color},**({'id':value_id} if value_id else {})),
+        html.P(note,className="small text-muted text-center mb-1") if note else None,
         html.P(name,className="text-muted text-center"),
         ]
     ),className='rounded-4 shadow-lg border-0 mb-5'
@@ -57,8 +87,8 @@ date_selector = html.Div([
                 id='date-picker',
                 min_date_allowed=date(2023, 1, 1),
                 max_date_allowed=date(2024, 12, 31),
-                end_date=date(2024, 12, 31),
-                start_date=date(2023, 1, 1),
+                end_date=date.fromisoformat(DEFAULT_DATE_END),
+                start_date=date.fromisoformat(DEFAULT_DATE_START),
         style={
         'display': 'flex',
         'justify-content': 'center',
@@ -74,7 +104,9 @@ controls = dbc.Card(
         html.H4('Controls',className="text-center",style={'color':MCCPDC_PRIMARY}),
         dbc.Row([
             date_selector,
-            group_select('PBM Data Sets', options=get_files(), multi=True, id='data-set'),
+            group_select('PBM Data Sets', options=registry.datasets(), multi=True, id='data-set'),
+            dcc.Interval(id='registry-poll', interval=max(REGISTRY_POLL_SECONDS, 1) * 1000,
+                         disabled=not REGISTRY_POLL_SECONDS),
             group_select('Drug Class', id='drug-class-group', multi=True),
             group_select('Drug Name', id='drug-group', multi=True),
             group_select('Pharmacy Type', options={'All': 'All', True: 'PBM-Affiliated Pharmacies', False: 'Non-Affiliated Pharmacies'},
@@ -89,11 +121,25 @@ controls = dbc.Card(
     ,className='border-0')
 
 
-app.layout = html.Div([
+KPI_CARDS = [('Total','total',MCCPDC_PRIMARY),('MCCPDC','mc_total',MCCPDC_PRIMARY),('Rx Ct','rx_ct',MCCPDC_PRIMARY),
+             ('Estimated Savings','mc_diff',MCCPDC_ACCENT),('Savings Per Rx','per_rx',MCCPDC_ACCENT),
+             ('Savings Percent','diff_pct',MCCPDC_ACCENT)]
+
+def kpi_placeholders():
+    # client crossfilter mode fills in the values; the cards themselves never change
+    return [kpi_card(name,'',color,value_id=f'kpi-{key}') for name,key,color in KPI_CARDS]
+
+def serve_layout():
+    # a fresh session id per page load lets the scheduler drop a user's superseded requests
+    return html.Div([
+    dcc.Store(id='session-id', data=uuid.uuid4().hex),
+    dcc.Store(id='view-etag'),
+    dcc.Store(id='crossfilter-data'),
+    dcc.Store(id='exact-request'),
     navi,
     dbc.Container([
         dbc.Row(
-            dbc.Col(dbc.Row(id='kpi-row',className="mt-4"))
+            dbc.Col(dbc.Row(kpi_placeholders() if CLIENT_CROSSFILTER else None,id='kpi-row',className="mt-4"))
         ),
         dbc.Row([
             html.Div(controls,className='col-lg-4'),
@@ -103,32 +149,40 @@ app.layout = html.Div([
             dbc.Col(create_fig_card('fig-savings-drug_class','MCCPDC % Savings vs PBMs by Drug Class'),className='col-lg-5'),
             dbc.Col(create_fig_card('fig-avg-charge','Average Charge Per Rx by Drug Class'),className='col-lg-7'),
         ]),
+        dbc.Row(
+            dbc.Col(create_fig_card('fig-trend','Monthly MCCPDC Estimated Savings'))
+        ),
     ],
     fluid=True),
     footer
 ])
 
-ALL_VALUE = 'All'  # Introduced constant for reused string
-
-def filter_data(data_set_list, affiliated_group, specialty_group,ftc_group, date_start=None, date_end=None,
-                drug_class_list=None,drug_name_list=None):
-    data = load_files(data_set_list)
-    if date_start and date_end:
-        start, end = [int(x) for x in date_start.split('-')], [int(x) for x in date_end.split('-')]
-        data = data.filter(c.dos.is_between(pl.date(start[0], start[1], start[2]), pl.date(end[0], end[1], end[2])))
-    if affiliated_group != ALL_VALUE:
-        data = data.filter(c.affiliated == affiliated_group)
-    if specialty_group != ALL_VALUE:
-        data = data.filter(c.is_special == specialty_group)
-    if drug_class_list:
-        data = data.filter(c.drug_class.is_in(drug_class_list))
-    if ftc_group != ALL_VALUE:
-        data = data.filter(c.is_ftc == ftc_group)
-    if drug_name_list:
-        data = data.filter(c.generic_name.is_in(drug_name_list))
-    return data
+app.layout = serve_layout
+
+def scheduled(session, lane, filters, work):
+    try:
+        return SCHEDULER.run(session, lane, filter_key(**filters), work)
+    except Superseded:
+        raise PreventUpdate
+
+def server_callback(*args, enabled=True, **kwargs):
+    # in client crossfilter mode the browser owns these outputs, so the server callback isn't registered
+    if CLIENT_CROSSFILTER or not enabled:
+        return lambda function: function
+    return app.callback(*args, **kwargs)
 
 @app.callback(
+    Output('data-set', 'options'),
+    Input('registry-poll', 'n_intervals'),
+    State('data-set', 'options'),
+    prevent_initial_call=True,
+)
+def update_data_set_options(n_intervals, current):
+    # data sets dropped into DATA_DIR show up without a page reload
+    datasets = registry.datasets()
+    return no_update if datasets == current else datasets
+
+@server_callback(
     Output('drug-class-group', 'options'),
     Input('data-set', 'value'),
     Input('affiliated-group', 'value'),
@@ -137,13 +191,14 @@ def filter_data(data_set_list, affiliated_group, specialty_group,ftc_group, date
     Input('date-picker', 'start_date'),
     Input('date-picker', 'end_date'),
     Input('drug-group', 'value'),
+    State('session-id', 'data'),
 )
-def update_control_group_options(data_set_list, affiliated_group, specialty_group,ftc_group,date_start, date_end,drug_name):
-    data = filter_data(data_set_list = data_set_list,affiliated_group= affiliated_group,specialty_group= specialty_group,ftc_group=ftc_group, date_start=date_start, date_end=date_end,drug_name_list=drug_name)
-    drug_group_options = data.select(c.drug_class).unique().sort(c.drug_class).collect().to_series().to_list()
-    return drug_group_options
+@instrument('update_control_group_options')
+def update_control_group_options(data_set_list, affiliated_group, specialty_group,ftc_group,date_start, date_end,drug_name,session):
+    filters = dict(data_set_list = data_set_list,affiliated_group= affiliated_group,specialty_group= specialty_group,ftc_group=ftc_group, date_start=date_start, date_end=date_end,drug_name_list=drug_name)
+    return scheduled(session, 'drug_class_options', filters, lambda checkpoint: facet_options('drug_class', **filters))
 
-@app.callback(
+@server_callback(
     Output('drug-group', 'options'),
     Input('data-set', 'value'),
     Input('affiliated-group', 'value'),
@@ -152,28 +207,15 @@ def update_control_group_options(data_set_list, affiliated_group, specialty_grou
     Input('drug-class-group', 'value'),
     Input('date-picker', 'start_date'),
     Input('date-picker', 'end_date'),
+    State('session-id', 'data'),
 )
-def update_generic_group_options(data_set_list, affiliated_group, specialty_group,ftc_group,drug_class_list,date_start, date_end):
-    data = filter_data(data_set_list = data_set_list,affiliated_group= affiliated_group,specialty_group= specialty_group,ftc_group=ftc_group,drug_class_list=drug_class_list, date_start=date_start, date_end=date_end)
-    drug_group_options = data.select(c.generic_name).unique().sort(c.generic_name).collect().to_series().to_list()
-    return drug_group_options
+@instrument('update_generic_group_options')
+def update_generic_group_options(data_set_list, affiliated_group, specialty_group,ftc_group,drug_class_list,date_start, date_end,session):
+    filters = dict(data_set_list = data_set_list,affiliated_group= affiliated_group,specialty_group= specialty_group,ftc_group=ftc_group,drug_class_list=drug_class_list, date_start=date_start, date_end=date_end)
+    return scheduled(session, 'generic_name_options', filters, lambda checkpoint: facet_options('generic_name', **filters))
 
-@app.callback(
-    Output('kpi-row','children'),
-    Input('data-set', 'value'),
-    Input('affiliated-group', 'value'),
-    Input('specialty-group', 'value'),
-    Input('ftc-group', 'value'),
-    Input('drug-class-group', 'value'),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-    Input('drug-group', 'value'),
-)
-def update_kpis(data_set_list,affiliated_group,specialty_group,ftc_group, drug_class_list,date_start,date_end,drug_name):
-    data = filter_data(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
-                       drug_class_list=drug_class_list,date_start=date_start, date_end=date_end,drug_name_list=drug_name)
-    data_dict = dict_for_kpis(data)
-    KPIS = [
+def kpi_cards(data_dict):
+    return [
         kpi_card('Total', f'{"${:,.0f}".format(data_dict["total"][0])}',MCCPDC_PRIMARY),
         kpi_card('MCCPDC', f'{"${:,.0f}".format(data_dict.get("mc_total")[0])}',MCCPDC_PRIMARY),
         kpi_card('Rx Ct', f'{"{:,}".format(data_dict.get("rx_ct")[0])}',MCCPDC_PRIMARY),
@@ -181,28 +223,25 @@ def update_kpis(data_set_list,affiliated_group,specialty_group,ftc_group, drug_c
         kpi_card('Savings Per Rx', f'{"${:,.2f}".format(data_dict.get("per_rx")[0])}',MCCPDC_ACCENT),
         kpi_card('Savings Percent', f'{"{:,.0%}".format(data_dict.get("diff_pct")[0])}', MCCPDC_ACCENT),
     ]
-    return KPIS
 
-@app.callback(
-    Output('scatter','figure'),
-    Input('data-set', 'value'),
-    Input('affiliated-group', 'value'),
-    Input('specialty-group', 'value'),
-    Input('ftc-group', 'value'),
-    Input('drug-class-group', 'value'),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-    Input('drug-group', 'value'),
-)
-def update_graph1(data_set_list,affiliated_group,specialty_group,ftc_group,drug_class_list,date_start,date_end,drug_name):
-    data = filter_data(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
-                       drug_class_list=drug_class_list,date_start=date_start, date_end=date_end, drug_name_list=drug_name)
+# value and interval formats of the estimated cards; the percent gets a decimal so its interval isn't ±0%
+ESTIMATE_FORMATS = {'total': ('${:,.0f}', '${:,.0f}'), 'mc_total': ('${:,.0f}', '${:,.0f}'), 'rx_ct': ('{:,.0f}', '{:,.0f}'),
+                    'mc_diff': ('${:,.0f}', '${:,.0f}'), 'per_rx': ('${:,.2f}', '${:,.2f}'), 'diff_pct': ('{:,.1%}', '{:,.1%}')}
 
-    fig = scatter_fig(data)
-    return fig
+def estimate_cards(estimates):
+    return [
+        kpi_card(name, f'≈ {ESTIMATE_FORMATS[key][0].format(estimates[key][0])}', color,
+                 note=f'± {ESTIMATE_FORMATS[key][1].format(estimates[key][1])} ({SAMPLE_CONFIDENCE:.0%} CI, sampled)')
+        for name, key, color in KPI_CARDS
+    ]
 
-@app.callback(
+@server_callback(
+    Output('kpi-row','children'),
+    Output('scatter','figure'),
     Output('fig-savings-drug_class','figure'),
+    Output('fig-avg-charge','figure'),
+    Output('fig-trend','figure'),
+    Output('view-etag','data'),
     Input('data-set', 'value'),
     Input('affiliated-group', 'value'),
     Input('specialty-group', 'value'),
@@ -211,66 +250,169 @@ def update_graph1(data_set_list,affiliated_group,specialty_group,ftc_group,drug_
     Input('date-picker', 'start_date'),
     Input('date-picker', 'end_date'),
     Input('drug-group', 'value'),
+    State('session-id', 'data'),
+    State('view-etag', 'data'),
+    enabled=not PROGRESSIVE,
 )
-def update_graph1(data_set_list,affiliated_group,specialty_group,ftc_group,drug_class_list,date_start,date_end, drug_name):
-    data = filter_data(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
+@instrument('update_dashboard')
+def update_dashboard(data_set_list,affiliated_group,specialty_group,ftc_group,drug_class_list,date_start,date_end,drug_name,session,shown_etag):
+    # one filtered frame, one batched query plan, all four panels; a newer state from the same
+    # session drops this one at the next checkpoint
+    filters = dict(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
+                   drug_class_list=drug_class_list,date_start=date_start, date_end=date_end,drug_name_list=drug_name)
+    etag = view_etag(data_version(), filter_key(**filters))
+    if etag == shown_etag:
+        # the browser already shows this view (e.g. a selection was cleared and re-made): send nothing
+        raise PreventUpdate
+
+    view = scheduled(session, 'dashboard', filters, lambda checkpoint: dashboard_view(etag, filters, checkpoint))
+    return kpi_cards(view['kpis']), view['scatter'], view['savings'], view['avg_charge'], view['trend'], etag
+
+if PROGRESSIVE:
+    @app.callback(
+        Output('kpi-row','children', allow_duplicate=True),
+        Output('exact-request','data'),
+        Input('data-set', 'value'),
+        Input('affiliated-group', 'value'),
+        Input('specialty-group', 'value'),
+        Input('ftc-group', 'value'),
+        Input('drug-class-group', 'value'),
+        Input('date-picker', 'start_date'),
+        Input('date-picker', 'end_date'),
+        Input('drug-group', 'value'),
+        State('session-id', 'data'),
+        State('view-etag', 'data'),
+        prevent_initial_call='initial_duplicate',
+    )
+    @instrument('preview_dashboard')
+    def preview_dashboard(data_set_list,affiliated_group,specialty_group,ftc_group,drug_class_list,date_start,date_end,drug_name,session,shown_etag):
+        # answers first with KPIs estimated from the ingest-time sample, then hands the state on to the
+        # exact update below; chained through the store so the exact cards always land after these
+        filters = dict(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
                        drug_class_list=drug_class_list,date_start=date_start, date_end=date_end,drug_name_list=drug_name)
+        # the state always goes on to the exact update, even for the view already shown: a newer request
+        # is what makes Dash drop an exact render still running for a state the user has left
+        etag = view_etag(data_version(), filter_key(**filters))
+        view = FIGURE_CACHE.get(etag)
+        if etag == shown_etag:
+            # back to the shown view before another one finished: its exact cards replace any estimates
+            # the abandoned state put up (the exact update sends nothing for it)
+            return (no_update if view is None else kpi_cards(view['kpis'])), filters
+        if view is not None:
+            # the exact view is already rendered: nothing to estimate
+            return no_update, filters
+        estimates = scheduled(session, 'preview', filters, lambda checkpoint: estimate_kpis(**filters))
+        return (no_update if estimates is None else estimate_cards(estimates)), filters
 
-    fig = bar_total_pct_savings(data)
-    return fig
+    @app.callback(
+        Output('kpi-row','children'),
+        Output('scatter','figure'),
+        Output('fig-savings-drug_class','figure'),
+        Output('fig-avg-charge','figure'),
+        Output('fig-trend','figure'),
+        Output('view-etag','data'),
+        Input('exact-request', 'data'),
+        State('session-id', 'data'),
+        State('view-etag', 'data'),
+        prevent_initial_call=True,
+    )
+    def update_dashboard_exact(filters, session, shown_etag):
+        return update_dashboard(filters['data_set_list'], filters['affiliated_group'], filters['specialty_group'],
+                                filters['ftc_group'], filters['drug_class_list'], filters['date_start'], filters['date_end'],
+                                filters['drug_name_list'], session, shown_etag)
 
-@app.callback(
-    Output('fig-avg-charge','figure'),
-    Input('data-set', 'value'),
-    Input('affiliated-group', 'value'),
-    Input('specialty-group', 'value'),
-    Input('ftc-group', 'value'),
-    Input('drug-class-group', 'value'),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-    Input('drug-group', 'value'),
+def clicked_filter(value, current):
+    # click drills down to the clicked item; clicking the item already selected clears the filter.
+    # Either way the new state refines (or widens back to) a cached one, so it is cheap to serve.
+    if current == [value]:
+        return None
+    return [value]
+
+@server_callback(
+    Output('drug-group','value'),
+    Input('scatter','clickData'),
+    State('drug-group','value'),
+    prevent_initial_call=True,
+)
+@instrument('click_drug_filter')
+def update_drug_filter(click_data, drug_group):
+    # scatter points carry the drug name as their text, not in customdata
+    return clicked_filter(click_data.get('points')[0].get('text'), drug_group)
+
+@server_callback(
+    Output('drug-class-group','value'),
+    Input('fig-avg-charge','clickData'),
+    Input('fig-savings-drug_class','clickData'),
+    State('drug-class-group','value'),
+    prevent_initial_call=True,
 )
-def update_graph1(data_set_list,affiliated_group,specialty_group,ftc_group,drug_class_list,date_start,date_end,drug_name):
-    data = filter_data(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,ftc_group=ftc_group,
-                       drug_class_list=drug_class_list,date_start=date_start, date_end=date_end, drug_name_list=drug_name)
-    fig = avg_charge_per_rx(data)
-    return fig
-#
-# @app.callback(
-#     Output('drug-group','value'),
-#     Input('scatter','clickData'),
-#     Input('drug-group','value'),
-#     prevent_initial_call=True,
-# )
-# def update_filter(click_data, drug_group):
-#     drug = (click_data.get('points')[0].get('customdata')[3])
-#     if not drug_group:
-#         return [drug]
-#     return None
-#
-# @app.callback(
-#     Output('drug-class-group','value'),
-#     Input('fig-avg-charge','clickData'),
-#     Input('drug-class-group','value'),
-#     prevent_initial_call=True,
-# )
-# def update_filter(click_data, drug_group):
-#     drug = (click_data.get('points')[0].get('customdata')[0])
-#     if not drug_group:
-#         return [drug]
-#     return None
-
-# @app.callback(
-#     Output('drug-class-group','value',allow_duplicate=True),
-#     Input('fig-savings-drug_class','clickData'),
-#     Input('drug-class-group','value'),
-#     prevent_initial_call=True,
-# )
-# def update_filter(click_data, drug_group):
-#     drug = (click_data.get('points')[0].get('customdata')[3])
-#     if not drug_group:
-#         return [drug]
-#     return None
+@instrument('click_drug_class_filter')
+def update_drug_class_filter(avg_charge_click, savings_click, drug_class_group):
+    if ctx.triggered_id == 'fig-avg-charge':
+        return clicked_filter(avg_charge_click.get('points')[0].get('customdata')[0], drug_class_group)
+    return clicked_filter(savings_click.get('points')[0].get('customdata')[3], drug_class_group)
+
+if CLIENT_CROSSFILTER:
+    @app.callback(
+        Output('crossfilter-data', 'data'),
+        Input('data-set', 'value'),
+        Input('date-picker', 'start_date'),
+        Input('date-picker', 'end_date'),
+        State('session-id', 'data'),
+    )
+    @instrument('update_crossfilter_data')
+    def update_crossfilter_data(data_set_list, date_start, date_end, session):
+        # the only server round-trip left: a new data set / date slice, aggregated to the dimensions
+        # the browser filters on
+        filters = slice_filters(data_set_list, date_start, date_end)
+        return scheduled(session, 'crossfilter', filters, lambda checkpoint: crossfilter_view(filters, checkpoint))
+
+    toggles = [Input('affiliated-group', 'value'), Input('specialty-group', 'value'), Input('ftc-group', 'value')]
+    clientside_callback(
+        ClientsideFunction('crossfilter', 'dashboard'),
+        *[Output(f'kpi-{key}', 'children') for _, key, _ in KPI_CARDS],
+        Output('scatter', 'figure'),
+        Output('fig-savings-drug_class', 'figure'),
+        Output('fig-avg-charge', 'figure'),
+        Output('fig-trend', 'figure'),
+        Input('crossfilter-data', 'data'), *toggles,
+        Input('drug-class-group', 'value'),
+        Input('drug-group', 'value'),
+    )
+    clientside_callback(
+        ClientsideFunction('crossfilter', 'class_options'),
+        Output('drug-class-group', 'options'),
+        Input('crossfilter-data', 'data'), *toggles,
+        Input('drug-group', 'value'),
+    )
+    clientside_callback(
+        ClientsideFunction('crossfilter', 'name_options'),
+        Output('drug-group', 'options'),
+        Input('crossfilter-data', 'data'), *toggles,
+        Input('drug-class-group', 'value'),
+    )
+    clientside_callback(
+        ClientsideFunction('crossfilter', 'click_drug'),
+        Output('drug-group', 'value'),
+        Input('scatter', 'clickData'),
+        State('drug-group', 'value'),
+        prevent_initial_call=True,
+    )
+    clientside_callback(
+        ClientsideFunction('crossfilter', 'click_class'),
+        Output('drug-class-group', 'value'),
+        Input('fig-avg-charge', 'clickData'),
+        Input('fig-savings-drug_class', 'clickData'),
+        State('drug-class-group', 'value'),
+        prevent_initial_call=True,
+    )
+
+# gunicorn imports this module in each worker before it accepts connections, so the warm-up runs
+# ahead of the first request there as well as under the dev server
+if WARM_UP:
+    with startup_phase('warm_up'):
+        warm_up(CLIENT_CROSSFILTER)
+log_startup()
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,326 @@
+// Client-side crossfilter: the server ships one aggregate per data set / date selection (see
+// crossfilter.py) and the toggles and class / drug selections are applied here. The aggregations
+// mirror calc.kpi_data and the fig.py builders.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    crossfilter: (function () {
+        const TYPES = {uint8: Uint8Array, uint16: Uint16Array, uint32: Uint32Array, float32: Float32Array,
+                       float64: Float64Array};
+        const FLAG_BITS = {affiliated: 1, is_special: 2, is_ftc: 4};
+        const decoded = new WeakMap();
+
+        function typedArray(spec) {
+            const binary = atob(spec.data);
+            const bytes = new Uint8Array(binary.length);
+            for (let i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            return new TYPES[spec.dtype](bytes.buffer);
+        }
+
+        function decode(payload) {
+            // the store keeps the same object until the slice changes, so each slice is decoded once
+            let cube = decoded.get(payload);
+            if (!cube) {
+                cube = Object.assign({}, payload);
+                for (const key of ['class_code', 'name_code', 'flags', 'total', 'mc_total', 'rx_ct', 'month_savings']) {
+                    cube[key] = typedArray(payload[key]);
+                }
+                decoded.set(payload, cube);
+            }
+            return cube;
+        }
+
+        function toggle(value) {
+            // same states as calc.as_bool: 'All' keeps both, 'true' / true keeps the flagged rows
+            if (value === null || value === undefined || value === 'All') {
+                return null;
+            }
+            return typeof value === 'string' ? value.toLowerCase() === 'true' : Boolean(value);
+        }
+
+        function codeSet(labels, values) {
+            if (!values || !values.length) {
+                return null;
+            }
+            const wanted = new Set(values);
+            return new Set(labels.map((label, code) => wanted.has(label) ? code : -1).filter(code => code >= 0));
+        }
+
+        function matcher(cube, filters) {
+            const toggles = [
+                [FLAG_BITS.affiliated, toggle(filters.affiliated)],
+                [FLAG_BITS.is_special, toggle(filters.specialty)],
+                [FLAG_BITS.is_ftc, toggle(filters.ftc)],
+            ].filter(([, value]) => value !== null);
+            const classes = codeSet(cube.classes, filters.classes);
+            const names = codeSet(cube.names, filters.names);
+            return function (row) {
+                for (const [bit, value] of toggles) {
+                    if (Boolean(cube.flags[row] & bit) !== value) {
+                        return false;
+                    }
+                }
+                return (!classes || classes.has(cube.class_code[row])) && (!names || names.has(cube.name_code[row]));
+            };
+        }
+
+        function rowsFor(cube, filters) {
+            const matches = matcher(cube, filters);
+            const rows = [];
+            for (let row = 0; row < cube.rows; row++) {
+                if (matches(row)) {
+                    rows.push(row);
+                }
+            }
+            return rows;
+        }
+
+        function sums(cube, rows, key) {
+            // totals per key(row), in first-seen order
+            const groups = new Map();
+            for (const row of rows) {
+                const id = key(row);
+                let group = groups.get(id);
+                if (!group) {
+                    group = {row: row, total: 0, mc_total: 0, rx_ct: 0};
+                    groups.set(id, group);
+                }
+                group.total += cube.total[row];
+                group.mc_total += cube.mc_total[row];
+                group.rx_ct += cube.rx_ct[row];
+            }
+            return Array.from(groups.values());
+        }
+
+        function byText(a, b) {
+            return a < b ? -1 : a > b ? 1 : 0;
+        }
+
+        // ---- KPI cards (app.kpi_cards) ----------------------------------------------------
+
+        function fixed(value, digits) {
+            if (Number.isNaN(value)) {
+                return 'nan';
+            }
+            if (!Number.isFinite(value)) {
+                return value > 0 ? 'inf' : '-inf';
+            }
+            return value.toLocaleString('en-US', {minimumFractionDigits: digits, maximumFractionDigits: digits});
+        }
+
+        function kpis(cube, rows) {
+            let total = 0, mc_total = 0, rx_ct = 0;
+            for (const row of rows) {
+                total += cube.total[row];
+                mc_total += cube.mc_total[row];
+                rx_ct += cube.rx_ct[row];
+            }
+            const mc_diff = total - mc_total;
+            return [
+                '$' + fixed(total, 0),
+                '$' + fixed(mc_total, 0),
+                fixed(rx_ct, 0),
+                '$' + fixed(mc_diff, 0),
+                '$' + fixed(mc_diff / rx_ct, 2),
+                fixed(mc_diff / total * 100, 0) + '%',
+            ];
+        }
+
+        // ---- scatter (fig.scatter_data, reduce_points, scatter_plot) ------------------------
+
+        function sizeNormalized(avg_diff) {
+            return avg_diff < 50 ? 1 : avg_diff < 100 ? 2 : avg_diff < 500 ? 4 : avg_diff < 1000 ? 8
+                : avg_diff < 5000 ? 16 : 32;
+        }
+
+        function scatterPoints(cube, rows) {
+            const points = sums(cube, rows, row => cube.name_code[row] * cube.classes.length + cube.class_code[row])
+                .map(group => Object.assign(group, {
+                    generic_name: cube.names[cube.name_code[group.row]],
+                    drug_class: cube.classes[cube.class_code[group.row]],
+                    diff: group.total - group.mc_total,
+                }))
+                .map(point => Object.assign(point, {avg_diff: point.diff / point.rx_ct}))
+                .filter(point => point.diff > 0 && point.avg_diff > 0)
+                .sort((a, b) => byText(a.generic_name, b.generic_name) || byText(a.drug_class, b.drug_class));
+            const settings = cube.scatter;
+            const ranked = points.slice().sort((a, b) => b.diff - a.diff);
+            const kept = new Set(ranked.slice(0, settings.max_points));
+            const cells = new Set();
+            for (const point of ranked.slice(settings.max_points)) {
+                const cell = Math.floor(Math.log10(point.diff) * settings.cells_per_decade) + ':'
+                    + Math.floor(Math.log10(point.total) * settings.cells_per_decade);
+                if (!cells.has(cell)) {
+                    cells.add(cell);
+                    kept.add(point);
+                }
+            }
+            return points.filter(point => kept.has(point));
+        }
+
+        function scatterFigure(cube, rows) {
+            const points = scatterPoints(cube, rows);
+            const type = points.length >= cube.scatter.webgl_min_points ? 'scattergl' : 'scatter';
+            const sizes = points.map(point => sizeNormalized(point.avg_diff));
+            const maxSize = Math.max(1, ...sizes);
+            const traces = new Map();
+            points.forEach((point, i) => {
+                let trace = traces.get(point.drug_class);
+                if (!trace) {
+                    trace = {
+                        type: type, mode: 'markers', name: point.drug_class, x: [], y: [], text: [], customdata: [],
+                        marker: {size: [], sizemode: 'area', sizeref: 2 * maxSize / 20 ** 2,
+                                 color: cube.colors[point.drug_class]},
+                        hovertemplate: '<b>Drug Name:</b> %{text}<br>'
+                            + '<b>Drug Class:</b> ' + point.drug_class + '<br>'
+                            + '<b>Rx Count:</b> %{customdata[1]:,.0f}<br>'
+                            + '<b>Total Charge:</b> %{y:$,.0f}<br>'
+                            + '<b>MCCPDC Total Charge:</b> %{customdata[2]:$,.0f}<br>'
+                            + '<b>Total Charge Difference:</b> %{x:$,.0f}<br>'
+                            + '<b>Average Difference Per Rx:</b> %{customdata[0]:$,.2f}<br>'
+                            + '<extra></extra>',
+                    };
+                    traces.set(point.drug_class, trace);
+                }
+                trace.x.push(point.diff);
+                trace.y.push(point.total);
+                trace.text.push(point.generic_name);
+                trace.customdata.push([point.avg_diff, point.rx_ct, point.mc_total]);
+                trace.marker.size.push(sizes[i]);
+            });
+            return {data: Array.from(traces.values()), layout: layout(cube, 'scatter')};
+        }
+
+        // ---- class bars (fig.savings_data / savings_plot, avg_charge_data / avg_charge_plot) ---
+
+        function classTotals(cube, rows) {
+            const classes = sums(cube, rows, row => cube.class_code[row])
+                .map(group => Object.assign(group, {
+                    drug_class: cube.classes[cube.class_code[group.row]],
+                    diff: group.total - group.mc_total,
+                }))
+                .filter(group => group.diff > 0);
+            const diffs = classes.reduce((sum, group) => sum + group.diff, 0);
+            return classes
+                .map(group => Object.assign(group, {avg_diff: group.diff / group.rx_ct, diff_pct: group.diff / diffs}))
+                .sort((a, b) => b.diff_pct - a.diff_pct);
+        }
+
+        function layout(cube, panel) {
+            return Object.assign(JSON.parse(JSON.stringify(cube.layouts[panel])), {template: cube.layouts.template});
+        }
+
+        function savingsFigure(cube, classes) {
+            const figure = {data: classes.map(group => ({
+                type: 'bar', orientation: 'h', name: group.drug_class, legendgroup: group.drug_class,
+                x: [group.diff_pct], y: [group.drug_class], text: [group.diff_pct],
+                customdata: [[group.avg_diff, group.diff, group.total, group.drug_class, group.rx_ct]],
+                marker: {color: cube.colors[group.drug_class]},
+                texttemplate: '%{text:.1%}', textposition: 'outside',
+                hovertemplate: '<b>Drug Class:</b> %{customdata[3]}<br>'
+                    + '<b>Rx Count:</b> %{customdata[4]:,.0f}<br>'
+                    + '<b>Total Charge Difference:</b> %{customdata[1]:$,.0f}<br>'
+                    + '<b>Total Charge:</b> %{customdata[2]:$,.0f}<br>'
+                    + '<b>Average Difference Per Rx:</b> %{customdata[0]:$,.2f}<br>'
+                    + '<extra></extra>',
+            })), layout: layout(cube, 'savings')};
+            const maxPct = classes.length ? classes[0].diff_pct : 0;
+            figure.layout.xaxis.range = [0, maxPct * 1.2];
+            // px lists horizontal categories bottom-up
+            figure.layout.yaxis.categoryorder = 'array';
+            figure.layout.yaxis.categoryarray = classes.map(group => group.drug_class).reverse();
+            return figure;
+        }
+
+        function avgChargeFigure(cube, classes) {
+            const ordered = classes
+                .map(group => Object.assign(group, {avg_charge: group.total / group.rx_ct,
+                                                    mc_avg_charge: group.mc_total / group.rx_ct}))
+                .sort((a, b) => a.avg_charge - b.avg_charge);
+            return {data: ordered.map(group => ({
+                type: 'bar', orientation: 'h', name: group.drug_class, legendgroup: group.drug_class,
+                x: [group.avg_charge, group.mc_avg_charge], y: ['avg_charge', 'mc_avg_charge'],
+                customdata: [[group.drug_class, group.avg_charge], [group.drug_class, group.mc_avg_charge]],
+                marker: {color: cube.colors[group.drug_class]},
+                texttemplate: '%{x}', textposition: 'auto',
+                hovertemplate: '<b>Drug Class:</b> %{customdata[0]}<br>'
+                    + '<b>Avgerage Rx Price:</b> %{customdata[1]:$,.2f}<br>'
+                    + '<extra></extra>',
+            })), layout: layout(cube, 'avg_charge')};
+        }
+
+        // ---- monthly trend (timeseries.monthly, fig.trend_plot) ------------------------------
+
+        function trendFigure(cube, rows) {
+            const months = cube.months.length;
+            const savings = new Array(months).fill(0);
+            for (const row of rows) {
+                for (let m = 0; m < months; m++) {
+                    savings[m] += cube.month_savings[row * months + m];
+                }
+            }
+            // trailing-window average from the running total, as the server takes it from prefix sums
+            const window = cube.trend.rolling_months;
+            const running = [0];
+            savings.forEach(value => running.push(running[running.length - 1] + value));
+            const rolling = savings.map((_, m) => {
+                const start = Math.max(m + 1 - window, 0);
+                return (running[m + 1] - running[start]) / (m + 1 - start);
+            });
+            return {data: [
+                {type: 'bar', x: cube.months, y: savings, name: 'Estimated Savings',
+                 marker: {color: cube.trend.colors[0]},
+                 hovertemplate: '<b>%{x|%b %Y}</b><br><b>Estimated Savings:</b> %{y:$,.0f}<br><extra></extra>'},
+                {type: 'scatter', mode: 'lines+markers', x: cube.months, y: rolling,
+                 name: window + '-Month Average', line: {color: cube.trend.colors[1], width: 3},
+                 hovertemplate: '<b>' + window + '-Month Average:</b> %{y:$,.0f}<br><extra></extra>'},
+            ], layout: layout(cube, 'trend')};
+        }
+
+        // ---- callbacks ------------------------------------------------------------------------
+
+        function options(cube, filters, labelsKey, codeKey) {
+            if (!cube) {
+                return [];
+            }
+            const codes = new Set(rowsFor(cube, filters).map(row => cube[codeKey][row]));
+            return Array.from(codes, code => cube[labelsKey][code]).sort(byText);
+        }
+
+        function clicked(value, current) {
+            // as app.clicked_filter: clicking the selected item again clears the filter
+            return current && current.length === 1 && current[0] === value ? null : [value];
+        }
+
+        return {
+            dashboard: function (payload, affiliated, specialty, ftc, classes, names) {
+                if (!payload) {
+                    return window.dash_clientside.no_update;
+                }
+                const cube = decode(payload);
+                const rows = rowsFor(cube, {affiliated, specialty, ftc, classes, names});
+                const totals = classTotals(cube, rows);
+                return kpis(cube, rows).concat([
+                    scatterFigure(cube, rows), savingsFigure(cube, totals), avgChargeFigure(cube, totals),
+                    trendFigure(cube, rows),
+                ]);
+            },
+            class_options: function (payload, affiliated, specialty, ftc, names) {
+                return options(payload && decode(payload), {affiliated, specialty, ftc, names}, 'classes', 'class_code');
+            },
+            name_options: function (payload, affiliated, specialty, ftc, classes) {
+                return options(payload && decode(payload), {affiliated, specialty, ftc, classes}, 'names', 'name_code');
+            },
+            click_drug: function (clickData, current) {
+                return clicked(clickData.points[0].text, current);
+            },
+            click_class: function (avgClick, savingsClick, current) {
+                const triggered = window.dash_clientside.callback_context.triggered_id;
+                if (triggered === 'fig-avg-charge') {
+                    return clicked(avgClick.points[0].customdata[0], current);
+                }
+                return clicked(savingsClick.points[0].customdata[3], current);
+            },
+        };
+    })(),
+});
@@ -0,0 +1,279 @@
+from pathlib import Path
+from datetime import date
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import polars as pl
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage
+    resource = None
+
+BENCH_DIR = Path('bench_data')
+SOURCE_DIR = Path('data')
+DATE_MIN, DATE_MAX = date(2023, 1, 1), date(2024, 12, 31)
+
+
+# ---- synthetic data -------------------------------------------------------------------------
+
+def generate(scale: int, out_dir: Path, seed: int = 0, source_dir: Path = SOURCE_DIR) -> Path:
+    # bootstrap rows from the real files (keeps the product/drug/class vocabulary and the skew of
+    # the measures), then jitter the money columns so repeated rows don't aggregate trivially
+    data_dir = out_dir / f'scale-{scale}' / 'data'
+    data_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for file in sorted(source_dir.glob('*.parquet')):
+        target = data_dir / file.name
+        if target.exists():
+            continue
+        source = pl.read_parquet(file)
+        rows = source.height * scale
+        # each chunk goes to its own part file and the parts are streamed into the target, so memory
+        # stays at one chunk however large the scale
+        parts_dir = data_dir / f'{file.stem}.parts'
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        parts_dir.mkdir()
+        for index, start in enumerate(range(0, rows, 2_000_000)):
+            n = min(2_000_000, rows - start)
+            sample = source[rng.integers(0, source.height, n)]
+            noise = rng.lognormal(0, 0.15, n).astype(np.float32)
+            sample.with_columns(
+                pl.col('total') * noise,
+                pl.col('mc_total') * noise,
+                pl.col('nadac') * noise,
+            ).write_parquet(parts_dir / f'part-{index:05d}.parquet')
+        # written under a temporary name: an interrupted run must not look finished to the exists() check
+        pl.scan_parquet(parts_dir / '*.parquet').sink_parquet(target.with_suffix('.tmp'))
+        target.with_suffix('.tmp').replace(target)
+        shutil.rmtree(parts_dir)
+    return data_dir
+
+
+# ---- filter sessions ------------------------------------------------------------------------
+
+def default_state() -> dict:
+    return dict(data_set_list=None, affiliated_group='All', specialty_group='All', ftc_group='All',
+                date_start=DATE_MIN.isoformat(), date_end=DATE_MAX.isoformat(),
+                drug_class_list=None, drug_name_list=None)
+
+
+def random_sessions(n_sessions: int, steps: int, files: list[str], classes: list[str], names: list[str],
+                    seed: int = 0) -> list[list[dict]]:
+    # each session starts at the default view and changes one control per step, the way users drill down
+    rng = random.Random(seed)
+    months = [date(y, m, 1) for y in (2023, 2024) for m in range(1, 13)]
+    sessions = []
+    for _ in range(n_sessions):
+        state = default_state()
+        session = [dict(state)]
+        for _ in range(steps):
+            control = rng.choice(['date', 'dataset', 'class', 'drug', 'affiliated', 'specialty', 'ftc'])
+            if control == 'date':
+                start, end = sorted(rng.sample(months, 2))
+                state['date_start'], state['date_end'] = start.isoformat(), end.isoformat()
+            elif control == 'dataset':
+                state['data_set_list'] = rng.sample(files, rng.randint(1, len(files))) if rng.random() < 0.8 else None
+            elif control == 'class':
+                state['drug_class_list'] = rng.sample(classes, rng.randint(1, 3)) if rng.random() < 0.8 else None
+            elif control == 'drug':
+                state['drug_name_list'] = rng.sample(names, rng.randint(1, 4)) if rng.random() < 0.6 else None
+            else:
+                key = {'affiliated': 'affiliated_group', 'specialty': 'specialty_group', 'ftc': 'ftc_group'}[control]
+                state[key] = rng.choice(['All', True, False])
+            session.append(dict(state))
+        sessions.append(session)
+    return sessions
+
+
+# ---- measurement ----------------------------------------------------------------------------
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        if resource is None:
+            return 0
+        # ru_maxrss is KiB on Linux, bytes on macOS; either way it is only a high-water mark
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RssSampler:
+    # polls resident set size on a thread while the measured call runs
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def operations() -> dict:
+    # imported here so MC_DATA_DIR / MC_CACHE_DIR are already pointing at the synthetic data
+    from calc import filter_data, dict_for_kpis
+    from fig import scatter_fig, bar_total_pct_savings, avg_charge_per_rx
+    from engine import dashboard_frames, dashboard_figures
+    from facets import facet_options
+    from query import query_data
+    from sampling import estimate_kpis
+
+    def options(state):
+        facet_options('drug_class', **{k: v for k, v in state.items() if k != 'drug_class_list'})
+        facet_options('generic_name', **{k: v for k, v in state.items() if k != 'drug_name_list'})
+
+    return {
+        'filter_data': lambda state: filter_data(**state).collect(),
+        'dict_for_kpis': lambda state: dict_for_kpis(filter_data(**state)),
+        'scatter_fig': lambda state: scatter_fig(filter_data(**state)),
+        'bar_total_pct_savings': lambda state: bar_total_pct_savings(filter_data(**state)),
+        'avg_charge_per_rx': lambda state: avg_charge_per_rx(filter_data(**state)),
+        'update_dashboard': lambda state: dashboard_figures(dashboard_frames(query_data(**state), filters=state)),
+        'update_options': options,
+        'preview_kpis': lambda state: estimate_kpis(**state),
+    }
+
+
+def summarize(samples: list[float], peaks: list[int], growth: list[int]) -> dict:
+    latencies = np.asarray(samples) * 1000
+    return {
+        'n': len(samples),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+        'peak_rss_mb': max(peaks) / 1024 ** 2,
+        'max_rss_growth_mb': max(growth) / 1024 ** 2,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale: int, n_sessions: int, steps: int, seed: int, sessions_file: Path | None = None,
+        only: list[str] | None = None) -> dict:
+    data_dir = generate(scale, BENCH_DIR, seed)
+    os.environ['MC_DATA_DIR'] = str(data_dir)
+    os.environ['MC_CACHE_DIR'] = str(data_dir.parent / 'cache')
+    from calc import get_files
+    from cube import load_cube
+    from ingest import ingest
+
+    started = time.perf_counter()
+    ingest()
+    startup = {'ingest_s': time.perf_counter() - started}
+    started = time.perf_counter()
+    cube = load_cube()
+    startup.update(cube_load_s=time.perf_counter() - started, cube_rows=cube.height)
+
+    files = get_files()
+    if sessions_file:
+        sessions = json.loads(sessions_file.read_text())
+    else:
+        sessions = random_sessions(n_sessions, steps, files, cube['drug_class'].unique().sort().to_list(),
+                                   cube['generic_name'].unique().sort().to_list(), seed)
+    ops = {name: op for name, op in operations().items() if not only or name in only}
+    samples = {name: [] for name in ops}
+    peaks = {name: [] for name in ops}
+    growth = {name: [] for name in ops}
+    for session in sessions:
+        for state in session:
+            for name, op in ops.items():
+                with RssSampler() as sampler:
+                    started = time.perf_counter()
+                    op(state)
+                    samples[name].append(time.perf_counter() - started)
+                peaks[name].append(sampler.peak)
+                growth[name].append(sampler.peak - sampler.baseline)
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'scale': scale,
+            'rows': sum(pl.scan_parquet(file).select(pl.len()).collect().item() for file in data_dir.glob('*.parquet')),
+            'sessions': len(sessions),
+            'states': sum(len(session) for session in sessions),
+            'seed': seed,
+            'python': platform.python_version(),
+            'polars': pl.__version__,
+            'cpus': os.cpu_count(),
+        },
+        'startup': startup,
+        'callbacks': {name: summarize(samples[name], peaks[name], growth[name]) for name in ops},
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, stats in current['callbacks'].items():
+        before = baseline['callbacks'].get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb'):
+            if before[metric] and stats[metric] > before[metric] * (1 + threshold):
+                regressions.append(f'{name} {metric}: {before[metric]:.1f} -> {stats[metric]:.1f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay filter sessions against the dashboard queries.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    gen = commands.add_parser('generate', help='write synthetic data sets at a scale factor')
+    gen.add_argument('--scale', type=int, default=10)
+    gen.add_argument('--seed', type=int, default=0)
+    bench = commands.add_parser('run', help='replay sessions and report latency/RSS per callback')
+    bench.add_argument('--scale', type=int, default=1)
+    bench.add_argument('--sessions', type=int, default=10)
+    bench.add_argument('--steps', type=int, default=8)
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--sessions-file', type=Path, help='recorded sessions: JSON list of lists of filter states')
+    bench.add_argument('--only', nargs='*', help='callbacks to measure (default: all)')
+    bench.add_argument('--out', type=Path, default=Path('bench_results.json'))
+    diff = commands.add_parser('compare', help='flag regressions between two result files')
+    diff.add_argument('baseline', type=Path)
+    diff.add_argument('current', type=Path)
+    diff.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        print(generate(args.scale, BENCH_DIR, args.seed))
+    elif args.command == 'run':
+        results = run(args.scale, args.sessions, args.steps, args.seed, args.sessions_file, args.only)
+        args.out.write_text(json.dumps(results, indent=2))
+        for name, stats in results['callbacks'].items():
+            print(f"{name:<24} p50 {stats['p50_ms']:8.1f}ms  p95 {stats['p95_ms']:8.1f}ms  "
+                  f"p99 {stats['p99_ms']:8.1f}ms  rss {stats['peak_rss_mb']:8.1f}MB")
+        print(f'results written to {args.out}')
+    else:
+        regressions = compare(json.loads(args.baseline.read_text()), json.loads(args.current.read_text()),
+                              args.threshold)
+        print('\n'.join(regressions) or 'no regressions')
+        sys.exit(1 if regressions else 0)
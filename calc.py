@@ -1,28 +1,170 @@
 from config import *
+from contextlib import contextmanager
 from pathlib import Path
+from functools import reduce
+import operator
+from urllib.parse import quote
+import hashlib
+import json
+import logging
 import polars as pl
 from polars import col as c
 import polars.selectors as cs
+from reference import SPECIALTY_LIST, FTC_LIST, reference_version
+from encoding import DRUG_CLASS_ENUM, encode, encode_names, extend_dictionaries
+from execution import collect
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server, no cross-process lock needed
+    fcntl = None
+
+# columns and types every PBM data set has to match; the store scans all data sets as one schema
+SOURCE_SCHEMA = {
+    'product': pl.String, 'generic_name': pl.String, 'drug_class': pl.String,
+    'year': pl.Int32, 'month': pl.Int8, 'is_less': pl.Boolean, 'affiliated': pl.Boolean,
+    'total': pl.Float32, 'mc_total': pl.Float32, 'nadac': pl.Float32, 'rx_ct': pl.UInt32,
+}
+
+logger = logging.getLogger('mc.datasets')
+
+def list_files() -> list[str]:
+    return sorted(str(file.stem) for file in DATA_DIR.glob('*.parquet'))
+
+def validate_dataset(file: str) -> list[str]:
+    # problems that would break the store scan or the enrichment; empty when the file can be loaded
+    path = DATA_DIR / f'{file}.parquet'
+    try:
+        schema = pl.read_parquet_schema(path)
+    except Exception as error:
+        return [f'unreadable: {error}']
+    problems = [f'missing column {column}' for column in SOURCE_SCHEMA if column not in schema]
+    problems += [f'unexpected column {column}' for column in schema if column not in SOURCE_SCHEMA]
+    problems += [f'{column} is {schema[column]}, expected {dtype}' for column, dtype in SOURCE_SCHEMA.items()
+                 if column in schema and schema[column] != dtype]
+    if not problems:
+        unknown = (
+            pl.scan_parquet(path)
+            .select(c.drug_class.unique())
+            .filter(c.drug_class.is_not_null() & ~c.drug_class.is_in(list(GROUP_DICT)))
+            .collect()
+            .to_series()
+            .to_list()
+        )
+        problems += [f'unknown drug class {name!r}' for name in unknown]
+    return problems
+
+_problems = {}
+
+def dataset_problems(file: str) -> list[str]:
+    # validated once per version of the file; a rejected one is logged when it is first seen
+    try:
+        stat = (DATA_DIR / f'{file}.parquet').stat()
+    except FileNotFoundError:
+        return ['removed']
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _problems.get(file)
+    if cached is None or cached[0] != key:
+        problems = validate_dataset(file)
+        if problems:
+            logger.error('skipping data set %s: %s', file, '; '.join(problems))
+        cached = _problems[file] = (key, problems)
+    return cached[1]
 
 def get_files() -> list[str]:
-    return [str(file.stem) for file in DATA_DIR.iterdir()]
+    # the data sets every process builds the store and the cube from: files that fail validation are
+    # left out here, so a bad drop into DATA_DIR can't break a worker's startup or a batch run
+    return [file for file in list_files() if not dataset_problems(file)]
 
 def is_special() -> pl.Expr:
-    return c.product.is_in(pl.read_parquet('specialty/specialty_list.parquet').select(c.product).to_series()).alias('is_special')
+    return c.product.is_in(SPECIALTY_LIST.values).alias('is_special')
 
 def dos():
     return pl.date(c.year,c.month,15).dt.month_start().alias('dos')
 
 def load_ftc_list():
-    return pl.scan_parquet('specialty/ftc_product.parquet').collect().to_series()
+    return FTC_LIST.values
 
 def is_ftc():
     return c.product.is_in(load_ftc_list()).alias('is_ftc')
 
+def class_group(streamable: bool = False) -> pl.Expr:
+    # the streaming engine can't run a dict replace; the when/then chain is slower but streams
+    if streamable:
+        return pl.coalesce([pl.when(c.drug_class == name).then(pl.lit(group)) for name, group in GROUP_DICT.items()]
+                           + [c.drug_class]).cast(DRUG_CLASS_ENUM).alias('drug_class')
+    return c.drug_class.replace(GROUP_DICT).cast(DRUG_CLASS_ENUM)
+
+def enrich(streamable: bool = False) -> list[pl.Expr]:
+    return [class_group(streamable),is_special(),dos(),is_ftc(),*encode_names()]
+
+STORE_VERSION = 2
+SORT_KEYS = ['affiliated', 'is_special', 'is_ftc', 'drug_class', 'generic_name', 'product']
+STORE_MANIFEST = STORE_DIR / 'manifest.json'
+
+def enrichment_fingerprint() -> str:
+    # the derived columns depend on the class mapping and the reference lists, not only the source file
+    return hashlib.sha1(json.dumps([STORE_VERSION, GROUP_DICT, SORT_KEYS, reference_version()]).encode()).hexdigest()
+
+def file_fingerprint(file: str) -> list:
+    stat = (DATA_DIR / f'{file}.parquet').stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+def dataset_version(file: str) -> list:
+    # changes whenever the data set's enriched rows would: a new source file or new enrichment inputs
+    return [enrichment_fingerprint(), *file_fingerprint(file)]
+
+def read_manifest() -> dict:
+    if not STORE_MANIFEST.exists():
+        return {'enrichment': None, 'datasets': {}}
+    return json.loads(STORE_MANIFEST.read_text())
+
+def current_datasets() -> list[str]:
+    # datasets whose partitions in the store match both their source file and the enrichment inputs
+    manifest = read_manifest()
+    if manifest['enrichment'] != enrichment_fingerprint():
+        return []
+    return [file for file, fingerprint in manifest['datasets'].items()
+            if (DATA_DIR / f'{file}.parquet').exists() and fingerprint == file_fingerprint(file)]
+
+@contextmanager
+def file_lock(path: Path):
+    # an exclusive lock shared by every process on the host, for work only one of them should do
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def dataset_dir(file: str) -> Path:
+    return STORE_DIR / f'dataset={quote(file, safe="")}'
+
+def scan_store(files: list[str]) -> pl.LazyFrame:
+    # one scan per data set: each was written against the name dictionaries of its own ingest, and a
+    # single scan can't mix those encodings, so each is widened to the current dictionaries first
+    return pl.concat([
+        pl.scan_parquet(dataset_dir(file) / '**' / '*.parquet', hive_partitioning=True,
+                        hive_schema={'dataset': pl.String, 'year': pl.Int32, 'month': pl.Int8})
+        .with_columns(encode())
+        for file in files
+    ])
+
+def scan_raw(files: list[str]) -> pl.LazyFrame:
+    extend_dictionaries(files)
+    return pl.concat([pl.scan_parquet(DATA_DIR / f'{file}.parquet').with_columns(*enrich(),pl.lit(file).alias('dataset')) for file in files])
+
 def load_files(files: list[str]|None) -> pl.LazyFrame:
-    if files:
-        return pl.scan_parquet([DATA_DIR / f'{file}.parquet' for file in files]).with_columns(c.drug_class.replace(GROUP_DICT),is_special(),dos(),is_ftc())
-    return pl.scan_parquet(DATA_DIR / '*.parquet').with_columns(c.drug_class.replace(GROUP_DICT),is_special(),dos(),is_ftc())
+    # ingested data sets come pre-enriched from the partitioned store; anything not ingested yet is enriched on the fly
+    files = files or get_files()
+    stored = set(current_datasets())
+    in_store = [file for file in files if file in stored]
+    not_stored = [file for file in files if file not in stored]
+    frames = ([scan_store(in_store)] if in_store else []) + ([scan_raw(not_stored)] if not_stored else [])
+    return pl.concat(frames, how='diagonal')
 
 def mc_diff():
     return (c.total - c.mc_total).alias('mc_diff')
@@ -30,17 +172,56 @@ def mc_diff():
 def mc_diff_per_rx():
     return (mc_diff() / c.rx_ct).alias('per_rx')
 
-def dict_for_kpis(data: pl.LazyFrame) -> dict:
+def kpi_data(data: pl.LazyFrame) -> pl.LazyFrame:
     return (
     data
     .select(cs.contains('total', 'rx_ct').sum())
     .with_columns(mc_diff())
     .with_columns(mc_diff_per_rx())
     .with_columns((c.mc_diff / c.total).alias('diff_pct'))
-    .collect()
-    .rename({})
-    .to_dict(as_series=False)
     )
 
+def dict_for_kpis(data: pl.LazyFrame) -> dict:
+    return collect(kpi_data(data)).to_dict(as_series=False)
+
+ALL_VALUE = 'All'  # Introduced constant for reused string
+
+def as_bool(value) -> bool:
+    # dropdown option keys arrive JSON-encoded, so True comes back as 'true'; comparing a
+    # boolean column against the string would cast every row to text
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+def filter_predicate(data_set_list=None, affiliated_group=ALL_VALUE, specialty_group=ALL_VALUE, ftc_group=ALL_VALUE,
+                     date_start=None, date_end=None, drug_class_list=None, drug_name_list=None) -> pl.Expr:
+    # the whole filter state as one boolean expression, so several states can be evaluated side by side
+    predicates = []
+    if data_set_list:
+        predicates.append(c.dataset.is_in(data_set_list))
+    if date_start and date_end:
+        start, end = [int(x) for x in date_start[:10].split('-')], [int(x) for x in date_end[:10].split('-')]
+        predicates.append(c.dos.is_between(pl.date(start[0], start[1], start[2]), pl.date(end[0], end[1], end[2])))
+    if affiliated_group != ALL_VALUE:
+        predicates.append(c.affiliated == as_bool(affiliated_group))
+    if specialty_group != ALL_VALUE:
+        predicates.append(c.is_special == as_bool(specialty_group))
+    if drug_class_list:
+        predicates.append(c.drug_class.is_in(drug_class_list))
+    if ftc_group != ALL_VALUE:
+        predicates.append(c.is_ftc == as_bool(ftc_group))
+    if drug_name_list:
+        predicates.append(c.generic_name.is_in(drug_name_list))
+    return reduce(operator.and_, predicates) if predicates else pl.lit(True)
+
+def filter_data(data_set_list, affiliated_group, specialty_group,ftc_group, date_start=None, date_end=None,
+                drug_class_list=None,drug_name_list=None, data: pl.LazyFrame|None=None):
+    # `data` lets callers filter a pre-aggregated source (the rollup cube) instead of the raw files
+    if data is None:
+        data = load_files(data_set_list)
+        data_set_list = None  # load_files only scanned the selected data sets
+    return data.filter(filter_predicate(data_set_list, affiliated_group, specialty_group, ftc_group, date_start, date_end,
+                                        drug_class_list, drug_name_list))
+
 if __name__ == '__main__':
     pass
@@ -1,5 +1,5 @@
 from pathlib import Path
-import plotly.express as px
+import os
 
 MCCPDC_PRIMARY = '#12366c'
 MCCPDC_SECONDARY = '#dcf2f9'
@@ -24,9 +24,89 @@ GROUP_DICT ={
     "Cardiovascular Agents (31-40)": 'Cardiovascular',
 }
 
-DATA_DIR = Path("data")
+DATA_DIR = Path(os.environ.get("MC_DATA_DIR", "data"))
+SPECIALTY_DIR = Path("specialty")
+CACHE_DIR = Path(os.environ.get("MC_CACHE_DIR", "cache"))
+STORE_DIR = CACHE_DIR / "store"
+SPILL_DIR = CACHE_DIR / "spill"
+REFERENCE_CHECK_INTERVAL = 5  # seconds between mtime checks of the specialty/FTC lists
+REGISTRY_POLL_SECONDS = float(os.environ.get("MC_REGISTRY_POLL_SECONDS", 10))  # 0 turns hot reload off
+
+# px.colors.qualitative.Light24_r in GROUP_DICT order, written out so importing config doesn't load plotly.express
+COLOR_MAPPING = {
+    'Respiratory': '#E48F72',
+    'Neuromuscular': '#FC6955',
+    'Stomach/GI': '#7E7DCD',
+    'Anti-Infective': '#BC7196',
+    'Endocrine': '#86CE00',
+    'Stimulants': '#E3EE9E',
+    'Nutritional': '#22FFA7',
+    'Central Nervous System': '#FF0092',
+    'Genitourinary': '#C9FBE5',
+    'Hematological': '#B68E00',
+    'Parkinson/Neurological': '#00B5F7',
+    'Miscellaneous': '#6E899C',
+    'Dermatological/ENT': '#D626FF',
+    'Pain/Inflammation': '#DC587D',
+    'Cancer': '#EEA6FB',
+    'Cardiovascular': '#479B55',
+}
+
+DEFAULT_DATE_START = '2023-01-01'  # the date picker's initial range, which is also the warmed-up view
+DEFAULT_DATE_END = '2024-12-31'
+WARM_UP = os.environ.get("MC_WARM_UP", "1") == "1"  # render the default view before serving
+
+
+
+QUERY_CACHE_MAX_ENTRIES = 64
+QUERY_CACHE_MAX_BYTES = 512 * 1024 ** 2
+API_CACHE_MAX_ENTRIES = 20_000  # per-scenario KPI results kept by the JSON/Arrow API
+API_MAX_SCENARIOS = 2_000  # scenarios accepted in one API request
+FIGURE_CACHE_MAX_BYTES = 128 * 1024 ** 2  # serialized dashboard views kept for repeat filter states
+
+SCATTER_MAX_POINTS = 1500  # largest-savings drugs always drawn exactly
+SCATTER_CELLS_PER_DECADE = 25  # log-log grid resolution for thinning the remaining drugs
+SCATTER_WEBGL_MIN_POINTS = 1000  # switch the scatter to WebGL at this many points
+TREND_ROLLING_MONTHS = 3  # trailing window of the monthly savings trend's rolling statistics
+
+# "server" renders every filter change on the server; "client" ships the data set / date slice to the
+# browser once and applies the toggles and class / drug selections there (assets/crossfilter.js)
+CROSSFILTER_MODE = os.environ.get("MC_CROSSFILTER", "server")
+
+# server mode answers a filter change with KPI estimates from a stratified sample first, then the exact
+# dashboard; the sample is drawn per data set at ingest (or on first use without it), stratified by drug class and month
+PROGRESSIVE_MODE = os.environ.get("MC_PROGRESSIVE", "1") == "1"
+SAMPLE_DIR = CACHE_DIR / "sample"
+SAMPLE_FRACTION = 0.05  # share of each stratum's rows kept in the sample
+SAMPLE_STRATUM_MIN = 10  # rows kept from every stratum (all of them in smaller ones)
+SAMPLE_CERTAINTY_QUANTILE = 0.99  # rows charging more than this share of a data set's rows are all kept
+SAMPLE_SEED = 0
+SAMPLE_CONFIDENCE = 0.95  # level of the intervals shown on the estimated KPI cards
+SAMPLE_MIN_MATCHED = 30  # fewer matching sample rows than this and the preview waits for the exact view
+
+METRICS_SLOW_QUERY_SECONDS = 0.5
+METRICS_SLOW_QUERY_SAMPLE_RATE = 1.0  # share of slow queries written to the slow-query log
+METRICS_SLOW_QUERY_KEEP = 200  # slow queries kept in memory for /metrics/slow-queries
+METRICS_PROFILE_SLOW_QUERIES = os.environ.get("MC_PROFILE_SLOW_QUERIES") == "1"
+METRICS_PAYLOAD_SAMPLE_RATE = 0.1  # share of responses parsed to measure per-figure bytes
+# set by gunicorn.conf.py: every worker writes its metrics here and /metrics serves their sum
+METRICS_DIR = Path(os.environ["MC_METRICS_DIR"]) if os.environ.get("MC_METRICS_DIR") else None
+METRICS_SNAPSHOT_SECONDS = 5  # how stale another worker's values can be in a scrape
+
+SCHEDULER_WORKERS = int(os.environ.get("MC_SCHEDULER_WORKERS", min(4, os.cpu_count() or 1)))  # concurrent dashboard queries per process
+SCHEDULER_MAX_SESSIONS = 10_000  # sessions whose latest request generation is remembered
 
-COLOR_MAPPING = {k:v for k,v in zip(GROUP_DICT.values(),px.colors.qualitative.Light24_r[:len(GROUP_DICT.values())])}
 
+def physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):  # not available on Windows
+        return 8 * 1024 ** 3
 
 
+# "memory" collects everything in memory, "streaming" always uses the streaming engine, "auto" streams
+# queries whose estimated input exceeds STREAMING_THRESHOLD_BYTES
+EXECUTION_MODE = os.environ.get("MC_EXECUTION_MODE", "auto")
+MEMORY_BUDGET_BYTES = int(os.environ.get("MC_MEMORY_BUDGET_MB", physical_memory() // 2 // 1024 ** 2)) * 1024 ** 2  # beyond this, spill to disk
+STREAMING_THRESHOLD_BYTES = int(os.environ.get("MC_STREAMING_THRESHOLD_MB", MEMORY_BUDGET_BYTES // 4 // 1024 ** 2)) * 1024 ** 2
+STREAMING_CHUNK_ROWS = int(os.environ.get("MC_STREAMING_CHUNK_ROWS", 0))  # 0 keeps polars' default
@@ -0,0 +1,125 @@
+from config import *
+import base64
+import functools
+import json
+import numpy as np
+import plotly.io as pio
+import polars as pl
+from polars import col as c
+from calc import ALL_VALUE
+from cube import data_version
+from engine import FIGURE_CACHE, view_etag
+from execution import collect
+from fig import avg_charge_plot, savings_plot, scatter_plot, trend_plot
+from metrics import phase
+from query import filter_key, query_data
+from timeseries import load_timeseries
+
+# what the browser filters on; data sets and dates are fixed by the server slice
+CROSSFILTER_DIMENSIONS = ['affiliated', 'is_special', 'is_ftc', 'drug_class', 'generic_name']
+FLAG_BITS = {'affiliated': 1, 'is_special': 2, 'is_ftc': 4}
+
+
+def typed_array(values: np.ndarray) -> dict:
+    # little-endian raw bytes, read in the browser as the matching TypedArray without parsing numbers
+    values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<'))
+    return {'dtype': values.dtype.name, 'data': base64.b64encode(values.tobytes()).decode()}
+
+
+def codes(series: pl.Series) -> tuple[list[str], np.ndarray]:
+    labels = sorted(series.cast(pl.String).unique().to_list())
+    dtype = np.uint8 if len(labels) <= 256 else np.uint16 if len(labels) <= 65536 else np.uint32
+    return labels, series.cast(pl.String).cast(pl.Enum(labels)).to_physical().to_numpy().astype(dtype)
+
+
+@functools.lru_cache(maxsize=1)
+def figure_layouts() -> dict:
+    # the builders' own layouts, drawn once from empty frames, so the browser only fills in traces
+    empty = pl.DataFrame(schema={'generic_name': pl.String, 'drug_class': pl.String, 'total': pl.Float64,
+                                 'mc_total': pl.Float64, 'diff': pl.Float64, 'rx_ct': pl.UInt32,
+                                 'avg_diff': pl.Float64, 'size_normalized': pl.Int32, 'diff_pct': pl.Float64,
+                                 'avg_charge': pl.Float64, 'mc_avg_charge': pl.Float64, 'month': pl.Date,
+                                 'savings': pl.Float64, 'savings_pct': pl.Float64, 'rolling_savings': pl.Float64,
+                                 'rolling_savings_pct': pl.Float64, 'rolling_savings_per_rx': pl.Float64})
+    figures = {'scatter': scatter_plot(empty), 'savings': savings_plot(empty), 'avg_charge': avg_charge_plot(empty),
+               'trend': trend_plot(empty)}
+    layouts = {panel: json.loads(pio.to_json(figure))['layout'] for panel, figure in figures.items()}
+    # every panel uses the same default template; it is shipped once and put back in the browser
+    layouts['template'] = [layout.pop('template') for layout in list(layouts.values())][0]
+    return layouts
+
+
+def crossfilter_frame(data: pl.LazyFrame) -> pl.DataFrame:
+    return collect(data.group_by(CROSSFILTER_DIMENSIONS).agg(c.total.sum(), c.mc_total.sum(), c.rx_ct.sum()))
+
+
+def monthly_matrix(frame: pl.DataFrame, filters: dict) -> tuple[list[str], np.ndarray]:
+    # each crossfilter row's savings per month of the slice, for the trend panel: the prefix-sum
+    # differences of its combinations (one per data set), added onto the row they fold into
+    index = load_timeseries()
+    rows = index.combo_rows(**filters)
+    low, high = index.bounds(filters.get('date_start'), filters.get('date_end'))
+    running = index.prefix['total'][rows, low:high + 1] - index.prefix['mc_total'][rows, low:high + 1]
+    targets = (
+        index.combos[rows]
+        .join(frame.select(CROSSFILTER_DIMENSIONS).with_row_index('row'), on=CROSSFILTER_DIMENSIONS, how='left',
+              join_nulls=True)['row']
+        .to_numpy()
+    )
+    present = ~np.isnan(targets.astype(np.float64))  # combinations without a cell in the range
+    matrix = np.zeros((frame.height, high - low))
+    np.add.at(matrix, targets[present].astype(np.int64), np.diff(running, axis=1)[present])
+    return [str(month) for month in index.months[low:high]], matrix
+
+
+def crossfilter_payload(frame: pl.DataFrame, months: list[str], savings: np.ndarray) -> dict:
+    # one row per toggle/class/drug combination of the slice: a few thousand rows, tens of KB, plus
+    # the rows' monthly savings (float32, row-major) for the trend
+    class_labels, class_codes = codes(frame['drug_class'])
+    name_labels, name_codes = codes(frame['generic_name'])
+    flags = np.zeros(frame.height, dtype=np.uint8)
+    for dim, bit in FLAG_BITS.items():
+        flags |= frame[dim].to_numpy().astype(np.uint8) * bit
+    return {
+        'rows': frame.height,
+        'classes': class_labels,
+        'names': name_labels,
+        'class_code': typed_array(class_codes),
+        'name_code': typed_array(name_codes),
+        'flags': typed_array(flags),
+        'total': typed_array(frame['total'].to_numpy().astype(np.float64)),
+        'mc_total': typed_array(frame['mc_total'].to_numpy().astype(np.float64)),
+        'rx_ct': typed_array(frame['rx_ct'].to_numpy().astype(np.uint32)),
+        'months': months,
+        'month_savings': typed_array(savings.astype(np.float32).ravel()),
+        'colors': COLOR_MAPPING,
+        'layouts': figure_layouts(),
+        'scatter': {'max_points': SCATTER_MAX_POINTS, 'cells_per_decade': SCATTER_CELLS_PER_DECADE,
+                    'webgl_min_points': SCATTER_WEBGL_MIN_POINTS},
+        'trend': {'rolling_months': TREND_ROLLING_MONTHS, 'colors': [MCCPDC_PRIMARY, MCCPDC_ACCENT]},
+    }
+
+
+def slice_filters(data_set_list=None, date_start=None, date_end=None) -> dict:
+    return dict(data_set_list=data_set_list, affiliated_group=ALL_VALUE, specialty_group=ALL_VALUE,
+                ftc_group=ALL_VALUE, date_start=date_start, date_end=date_end)
+
+
+def crossfilter_etag(filters: dict) -> str:
+    return view_etag(data_version(), 'crossfilter:' + filter_key(**filters))
+
+
+def crossfilter_view(filters: dict, checkpoint=lambda: None) -> dict:
+    # payloads share the figure cache with the server-rendered views
+    etag = crossfilter_etag(filters)
+    view = FIGURE_CACHE.get(etag)
+    if view is not None:
+        return view['crossfilter']
+    with phase('query'):
+        data = query_data(**filters)
+    checkpoint()
+    with phase('aggregate'):
+        frame = crossfilter_frame(data)
+        payload = crossfilter_payload(frame, *monthly_matrix(frame, filters))
+    FIGURE_CACHE.put(etag, {'crossfilter': payload})
+    return payload
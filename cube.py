@@ -0,0 +1,152 @@
+from config import *
+import argparse
+import hashlib
+import json
+import threading
+import polars as pl
+from polars import col as c
+from calc import dataset_version, file_lock, get_files, load_files
+from encoding import encode
+from execution import collect, source_bytes
+from reference import reference_version
+
+CUBE_VERSION = 4
+CUBE_DIMENSIONS = ['dataset', 'dos', 'affiliated', 'is_special', 'is_ftc', 'drug_class', 'generic_name']
+CUBE_MEASURES = ['total', 'mc_total', 'rx_ct']
+CUBE_META_PATH = CACHE_DIR / 'cube.json'
+
+_cube = None
+_cube_version = None
+_cube_datasets = {}
+_cube_lock = threading.Lock()
+
+
+def source_datasets() -> dict[str, list]:
+    return {file: dataset_version(file) for file in get_files()}
+
+
+def source_fingerprint(datasets: dict[str, list] | None = None) -> str:
+    # anything that changes a cell value has to change the fingerprint; the data set versions cover
+    # both the source files and the enrichment inputs
+    datasets = source_datasets() if datasets is None else datasets
+    payload = json.dumps([CUBE_VERSION, CUBE_DIMENSIONS, CUBE_MEASURES, GROUP_DICT, reference_version(),
+                          sorted(datasets.items())], default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def rollup(data: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        data
+        .group_by(CUBE_DIMENSIONS)
+        .agg(c.total.cast(pl.Float64).sum(), c.mc_total.cast(pl.Float64).sum(), c.rx_ct.sum())
+        .sort(CUBE_DIMENSIONS)
+    )
+
+
+def build_cube(files: list[str] | None = None) -> pl.DataFrame:
+    return collect(rollup(load_files(files)), source_bytes(files))
+
+
+def build_lock():
+    # several workers may find the cube stale at once; only one of them should build it
+    return file_lock(CACHE_DIR / 'cube.lock')
+
+
+def cube_path(fingerprint: str) -> Path:
+    return CACHE_DIR / f'cube-{fingerprint[:16]}.arrow'
+
+
+def write_cube(cube: pl.DataFrame, fingerprint: str, datasets: dict[str, list]):
+    # uncompressed Arrow IPC so every worker can memory-map the same file instead of holding a copy;
+    # the name is versioned, so a rebuild never rewrites a file another process has mapped
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = cube_path(fingerprint)
+    cube.write_ipc(path.with_suffix('.tmp'), compression='uncompressed')
+    path.with_suffix('.tmp').replace(path)
+    meta = CUBE_META_PATH.with_suffix('.tmp')
+    meta.write_text(json.dumps({'fingerprint': fingerprint, 'rows': cube.height, 'path': path.name, 'datasets': datasets}))
+    meta.replace(CUBE_META_PATH)
+    for old in CACHE_DIR.glob('cube-*.arrow'):
+        if old != path:
+            try:
+                old.unlink(missing_ok=True)
+            except OSError:  # Windows won't delete a file another process still has mapped
+                pass
+
+
+def published_meta() -> dict:
+    if not CUBE_META_PATH.exists():
+        return {}
+    return json.loads(CUBE_META_PATH.read_text())
+
+
+def published_version() -> str | None:
+    return published_meta().get('fingerprint')
+
+
+def read_cube(fingerprint: str) -> pl.DataFrame | None:
+    if published_version() != fingerprint or not cube_path(fingerprint).exists():
+        return None
+    return pl.read_ipc(cube_path(fingerprint), memory_map=True)
+
+
+def load_cube(rebuild: bool = False) -> pl.DataFrame:
+    global _cube, _cube_version, _cube_datasets
+    with _cube_lock:
+        if _cube is None or rebuild:
+            datasets = source_datasets()
+            fingerprint = source_fingerprint(datasets)
+            cube = None if rebuild else read_cube(fingerprint)
+            if cube is None:
+                with build_lock():
+                    cube = None if rebuild else read_cube(fingerprint)
+                    if cube is None:
+                        write_cube(build_cube(list(datasets)), fingerprint, datasets)
+                        cube = read_cube(fingerprint)
+            _cube, _cube_version, _cube_datasets = cube, fingerprint, datasets
+        return _cube
+
+
+def update_cube(changed: list[str], removed: list[str]) -> pl.DataFrame:
+    # re-rolls only the changed data sets and splices their cells into the current cube; every
+    # worker calls this for the same change, the first one to get the lock publishes the result
+    global _cube, _cube_version, _cube_datasets
+    load_cube()
+    with _cube_lock:
+        current, datasets = _cube, dict(_cube_datasets)
+    for file in removed:
+        datasets.pop(file, None)
+    datasets.update({file: dataset_version(file) for file in changed})
+    fingerprint = source_fingerprint(datasets)
+    with build_lock():
+        cube = read_cube(fingerprint)
+        if cube is None:
+            parts = [current.filter(~c.dataset.is_in(changed + removed))]
+            if changed:
+                parts.append(build_cube(changed))
+            # cells rolled up against older name dictionaries are widened to the current ones
+            merged = pl.concat([part.with_columns(encode(['drug_class', 'generic_name'])) for part in parts])
+            write_cube(merged.sort(CUBE_DIMENSIONS), fingerprint, datasets)
+            cube = read_cube(fingerprint)
+    with _cube_lock:
+        _cube, _cube_version, _cube_datasets = cube, fingerprint, datasets
+    return cube
+
+
+def cube_snapshot() -> tuple[pl.DataFrame, dict[str, list]]:
+    # the cube together with the version of every data set rolled into it
+    load_cube()
+    with _cube_lock:
+        return _cube, _cube_datasets
+
+
+def data_version() -> str | None:
+    return _cube_version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and publish the rollup cube.')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild even if the published cube is current')
+    args = parser.parse_args()
+    cube = load_cube(rebuild=args.rebuild)
+    print(f'{cube.height:,} cells, version {data_version()}, at {cube_path(data_version())}')
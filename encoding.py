@@ -0,0 +1,92 @@
+from config import *
+import json
+import threading
+import polars as pl
+from polars import col as c
+
+# drug classes are a closed set, fixed by GROUP_DICT; sorted so physical order is display order
+DRUG_CLASS_ENUM = pl.Enum(sorted(set(GROUP_DICT.values())))
+NAME_COLUMNS = ['generic_name', 'product']
+DICTIONARY_PATH = STORE_DIR / 'dictionaries.json'
+
+_dictionaries = None
+_dictionaries_stamp = None
+_dictionaries_lock = threading.RLock()
+
+
+def read_dictionaries() -> dict:
+    if DICTIONARY_PATH.exists():
+        return json.loads(DICTIONARY_PATH.read_text())
+    return {'sources': {}, **{column: [] for column in NAME_COLUMNS}}
+
+
+def merge_dictionaries(base: dict, extra: dict) -> dict:
+    merged = {}
+    for column in NAME_COLUMNS:
+        known = set(base[column])
+        merged[column] = base[column] + [name for name in extra[column] if name not in known]
+    merged['sources'] = {**extra['sources'], **base['sources']}
+    return merged
+
+
+def dictionaries() -> dict:
+    # re-read when ingest (possibly another process) has persisted new names; anything this process
+    # appended on its own is kept after the persisted entries
+    global _dictionaries, _dictionaries_stamp
+    with _dictionaries_lock:
+        stamp = DICTIONARY_PATH.stat().st_mtime_ns if DICTIONARY_PATH.exists() else None
+        if _dictionaries is None or stamp != _dictionaries_stamp:
+            persisted = read_dictionaries()
+            _dictionaries = persisted if _dictionaries is None else merge_dictionaries(persisted, _dictionaries)
+            _dictionaries_stamp = stamp
+        return _dictionaries
+
+
+def source_stamp(file: str) -> list:
+    stat = (DATA_DIR / f'{file}.parquet').stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def extend_dictionaries(files: list[str], persist: bool = False) -> bool:
+    # dictionaries are append-only: new names get new codes at the end, existing codes never move,
+    # so data encoded against an older dictionary stays valid and only needs a widening cast
+    global _dictionaries, _dictionaries_stamp
+    with _dictionaries_lock:
+        current = dictionaries()
+        pending = [file for file in files if current['sources'].get(file) != source_stamp(file)]
+        if not pending and not (persist and current != read_dictionaries()):
+            return False
+        updated = {column: list(current[column]) for column in NAME_COLUMNS}
+        updated['sources'] = dict(current['sources'])
+        for column in NAME_COLUMNS:
+            if not pending:
+                break
+            names = pl.concat([pl.scan_parquet(DATA_DIR / f'{file}.parquet').select(column) for file in pending])
+            known = set(updated[column])
+            seen = names.select(c(column).unique().sort()).collect().to_series().drop_nulls().to_list()
+            updated[column].extend(name for name in seen if name not in known)
+        for file in pending:
+            updated['sources'][file] = source_stamp(file)
+        _dictionaries = updated
+        if persist:
+            DICTIONARY_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp = DICTIONARY_PATH.with_suffix('.tmp')
+            tmp.write_text(json.dumps(updated))
+            tmp.replace(DICTIONARY_PATH)
+            _dictionaries_stamp = DICTIONARY_PATH.stat().st_mtime_ns
+        return True
+
+
+def name_enum(column: str) -> pl.Enum:
+    return pl.Enum(dictionaries()[column])
+
+
+def encode_names() -> list[pl.Expr]:
+    # filters and group-bys then run on integer codes instead of hashing strings
+    return [c(column).cast(name_enum(column)) for column in NAME_COLUMNS]
+
+
+def encode(columns: list[str] | None = None) -> list[pl.Expr]:
+    # brings already-encoded data up to the current dictionaries (a no-op when they haven't grown)
+    columns = columns or ['drug_class', *NAME_COLUMNS]
+    return [c(column).cast(DRUG_CLASS_ENUM if column == 'drug_class' else name_enum(column)) for column in columns]
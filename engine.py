@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from config import *
+import hashlib
+import threading
+import polars as pl
+from plotly.io.json import to_json_plotly
+from calc import kpi_data
+from execution import collect_all
+from fig import *
+from metrics import phase
+from query import query_data
+from timeseries import monthly_savings
+
+PANELS = ['kpis', 'scatter', 'savings', 'avg_charge']
+
+
+def dashboard_plans(data: pl.LazyFrame) -> dict[str, pl.LazyFrame]:
+    # every panel hangs off the same per-drug rollup; collect_all's common-subplan elimination
+    # runs that scan and group-by once for the whole batch
+    drugs = drug_totals(data)
+    classes = class_totals(drugs)
+    return {
+        'kpis': kpi_data(classes),
+        'scatter': scatter_points(drugs),
+        'savings': savings_data(classes),
+        'avg_charge': avg_charge_data(classes),
+    }
+
+
+def dashboard_frames(data: pl.LazyFrame, panels: list[str] | None = None,
+                     filters: dict | None = None) -> dict[str, pl.DataFrame]:
+    plans = dashboard_plans(data)
+    panels = panels or PANELS
+    frames = dict(zip(panels, collect_all([plans[panel] for panel in panels])))
+    if filters is not None:
+        # the trend runs along the months `data` has summed away, so it comes from the prefix sums
+        frames['trend'] = monthly_savings(**filters)
+    return frames
+
+
+def dashboard_figures(frames: dict[str, pl.DataFrame]) -> dict:
+    return {
+        'kpis': frames['kpis'].to_dict(as_series=False),
+        'scatter': scatter_plot(frames['scatter']),
+        'savings': savings_plot(frames['savings']),
+        'avg_charge': avg_charge_plot(frames['avg_charge']),
+        **({'trend': trend_plot(frames['trend'])} if 'trend' in frames else {}),
+    }
+
+
+def serialize_figures(figures: dict) -> dict:
+    # plain dicts, numeric arrays already base64-encoded: cheap for Dash to send again
+    return {panel: value if panel == 'kpis' else value.to_dict() for panel, value in figures.items()}
+
+
+def view_etag(data_version: str | None, filter_key: str) -> str:
+    # a view is fully determined by the data and the filter state
+    return hashlib.sha1(f'{data_version}:{filter_key}'.encode()).hexdigest()[:20]
+
+
+class FigureCache:
+    # LRU of serialized dashboard views by etag, bounded by their JSON size
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._views = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, etag: str) -> dict | None:
+        with self._lock:
+            entry = self._views.get(etag)
+            if entry is None:
+                return None
+            self._views.move_to_end(etag)
+            return entry[0]
+
+    def put(self, etag: str, view: dict):
+        # sized as the JSON Dash sends: px figures keep numpy arrays and the trend keeps dates, which
+        # only plotly's encoder writes out in full
+        size = len(to_json_plotly(view))
+        with self._lock:
+            if etag in self._views or size > self.max_bytes:
+                return
+            self._views[etag] = (view, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._views.popitem(last=False)
+                self._bytes -= evicted
+
+
+FIGURE_CACHE = FigureCache(FIGURE_CACHE_MAX_BYTES)
+
+
+def dashboard_view(etag: str, filters: dict, checkpoint=lambda: None) -> dict:
+    # the serialized view for a filter state, from the figure cache or computed and cached;
+    # `checkpoint` runs between the phases so a superseded request stops early
+    view = FIGURE_CACHE.get(etag)
+    if view is not None:
+        return view
+    with phase('query'):
+        data = query_data(**filters)
+    checkpoint()
+    with phase('aggregate'):
+        frames = dashboard_frames(data, filters=filters)
+    checkpoint()
+    with phase('render'):
+        view = serialize_figures(dashboard_figures(frames))
+    FIGURE_CACHE.put(etag, view)
+    return view
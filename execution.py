@@ -0,0 +1,212 @@
+from config import *
+from contextlib import contextmanager
+import argparse
+import functools
+import os
+import re
+import threading
+import polars as pl
+import polars.selectors as cs
+
+# where the streaming engine spills group-by and sort state; polars reads this when it first spills
+os.environ.setdefault('POLARS_TEMP_DIR', str(SPILL_DIR))
+if STREAMING_CHUNK_ROWS:
+    pl.Config.set_streaming_chunk_size(STREAMING_CHUNK_ROWS)
+
+STRING_BYTES = 16  # rough in-memory width of the short product/drug/class strings
+DTYPE_BYTES = {pl.Boolean: 1, pl.Int8: 1, pl.UInt8: 1, pl.Int16: 2, pl.UInt16: 2, pl.Int32: 4, pl.UInt32: 4,
+               pl.Float32: 4, pl.Date: 4}
+
+# a scan in a plan's explain output: its first source, and how many more there are after pruning
+SCAN_SOURCES = re.compile(r'SCAN \[(?P<first>[^,\]]+)(?:, \.\.\. (?P<more>\d+) other sources)?\]')
+
+
+
+class CollectLock:
+    # shared by ordinary collects, exclusive for a spilling one. A waiting spill holds back new shared
+    # holders, so a steady stream of dashboard queries can't starve it.
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+_collects = CollectLock()
+
+
+@functools.lru_cache(maxsize=256)
+def file_bytes(path: str, size: int, mtime_ns: int) -> int:
+    # rows from the parquet footer times the in-memory row width; size/mtime only key the cache
+    schema = pl.read_parquet_schema(path)
+    rows = pl.scan_parquet(path).select(pl.len()).collect().item()
+    width = sum(STRING_BYTES if dtype == pl.String else DTYPE_BYTES.get(dtype, 8) for dtype in schema.values())
+    return rows * width
+
+
+def path_bytes(path: Path) -> int:
+    stat = path.stat()
+    return file_bytes(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def source_bytes(files: list[str] | None = None) -> int:
+    paths = [DATA_DIR / f'{file}.parquet' for file in files] if files else DATA_DIR.glob('*.parquet')
+    return sum(path_bytes(path) for path in paths)
+
+
+def scan_bytes(first: Path, sources: int) -> int:
+    # explain lists only a scan's first source and a count of the others. A store partition stands for
+    # its data set's share of partitions left after pruning; any other file for that many of its size.
+    store = next((parent for parent in first.parents if parent.name.startswith('dataset=')), None)
+    if store is None:
+        return path_bytes(first) * sources
+    partitions = list(store.glob('**/*.parquet'))
+    return sum(path_bytes(path) for path in partitions) * sources // max(len(partitions), 1)
+
+
+def plan_bytes(plan: pl.LazyFrame) -> int:
+    # frames a plan starts from are already resident; only its scans can outgrow memory, sized from the
+    # files and partitions the optimized plan still reads. A source explain doesn't show in a form we can
+    # find on disk is taken to be the whole of DATA_DIR.
+    total = 0
+    for scan in SCAN_SOURCES.finditer(plan.explain()):
+        first = Path(scan['first'])
+        if not first.is_file():
+            return source_bytes()
+        total += scan_bytes(first, 1 + int(scan['more'] or 0))
+    return total
+
+
+def use_streaming(input_bytes: int) -> bool:
+    if EXECUTION_MODE == 'memory':
+        return False
+    return EXECUTION_MODE == 'streaming' or input_bytes > STREAMING_THRESHOLD_BYTES
+
+
+@contextmanager
+def spilling(input_bytes: int, streaming: bool = True):
+    # inputs beyond the memory budget run with group-bys and sorts forced out of core. Polars only takes
+    # that from the environment, which is the whole process's: a spilling query waits for every other
+    # collect here to finish and runs alone, so none of them picks the setting up. Collects made
+    # directly on a frame rather than through this module aren't held back.
+    if not streaming or input_bytes <= MEMORY_BUDGET_BYTES:
+        with _collects.shared():
+            yield
+        return
+    with _collects.exclusive():
+        SPILL_DIR.mkdir(parents=True, exist_ok=True)
+        previous = os.environ.get('POLARS_FORCE_OOC')
+        os.environ['POLARS_FORCE_OOC'] = '1'
+        try:
+            yield
+        finally:
+            if previous is None:
+                os.environ.pop('POLARS_FORCE_OOC', None)
+            else:
+                os.environ['POLARS_FORCE_OOC'] = previous
+
+
+def input_size(plans: list[pl.LazyFrame], input_bytes: int | None) -> int:
+    if input_bytes is not None or EXECUTION_MODE != 'auto':
+        return input_bytes or 0
+    return max(plan_bytes(plan) for plan in plans)
+
+
+def collect(plan: pl.LazyFrame, input_bytes: int | None = None) -> pl.DataFrame:
+    # every dashboard, KPI and build query goes through here; `input_bytes` skips the estimate
+    input_bytes = input_size([plan], input_bytes)
+    streaming = use_streaming(input_bytes)
+    with spilling(input_bytes, streaming):
+        return plan.collect(streaming=streaming)
+
+
+def collect_all(plans: list[pl.LazyFrame], input_bytes: int | None = None) -> list[pl.DataFrame]:
+    input_bytes = input_size(plans, input_bytes)
+    streaming = use_streaming(input_bytes)
+    with spilling(input_bytes, streaming):
+        return pl.collect_all(plans, streaming=streaming)
+
+
+def sink_parquet(plan: pl.LazyFrame, path: Path, input_bytes: int, **options):
+    # streamed straight to disk when streaming, so the result never has to fit in memory either
+    streaming = use_streaming(input_bytes)
+    with spilling(input_bytes, streaming):
+        if streaming:
+            plan.sink_parquet(path, **options)
+        else:
+            plan.collect().write_parquet(path, **options)
+
+
+def verify(states: list[dict]) -> list[str]:
+    # the streaming engine has to give the in-memory answers for the KPIs and every figure's data
+    from polars.testing import assert_frame_equal
+    from calc import filter_data, kpi_data
+    from fig import avg_charge_data, class_totals, drug_totals, savings_data, scatter_points
+
+    builders = {
+        'dict_for_kpis': kpi_data,
+        'scatter_fig': lambda data: scatter_points(drug_totals(data)),
+        'bar_total_pct_savings': lambda data: savings_data(class_totals(data)),
+        'avg_charge_per_rx': lambda data: avg_charge_data(class_totals(data)),
+    }
+    mismatches = []
+    for state in states:
+        # measures are widened first: the Float32 sums shift in the 6th digit with summation order, and
+        # a drug's savings (a difference of two such sums) would turn that noise into false mismatches
+        data = filter_data(**state).with_columns(cs.float().cast(pl.Float64))
+        for name, build in builders.items():
+            plan = build(data)
+            with spilling(0, streaming=False):
+                in_memory = plan.collect()
+            with spilling(MEMORY_BUDGET_BYTES + 1):
+                streamed = plan.collect(streaming=True)
+            try:
+                assert_frame_equal(in_memory.sort(in_memory.columns), streamed.sort(streamed.columns),
+                                   check_exact=False, rtol=1e-9)
+            except AssertionError as error:
+                mismatches.append(f'{name} {state}: {str(error).splitlines()[0]}')
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check streaming execution against in-memory results.')
+    parser.add_argument('--sessions', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    from benchmark import random_sessions
+    from calc import get_files
+    from cube import load_cube
+
+    cube = load_cube()
+    sessions = random_sessions(args.sessions, args.steps, get_files(), cube['drug_class'].unique().sort().to_list(),
+                               cube['generic_name'].unique().sort().to_list(), args.seed)
+    states = [state for session in sessions for state in session]
+    mismatches = verify(states)
+    print('\n'.join(mismatches) or f'streaming matches in-memory for {len(states)} filter states')
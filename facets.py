@@ -0,0 +1,115 @@
+from config import *
+from datetime import date
+import threading
+import numpy as np
+import polars as pl
+from polars import col as c
+from calc import ALL_VALUE, as_bool
+from cube import cube_snapshot
+
+FACET_DIMENSIONS = ['dos', 'affiliated', 'is_special', 'is_ftc', 'drug_class', 'generic_name']
+
+
+def as_date(value: str) -> date:
+    return date.fromisoformat(value[:10])
+
+
+class FacetIndex:
+    # for every value of every filter dimension, the sorted cube row ids it appears in;
+    # a filter state is the intersection of the unions of its selected values. One index per data set.
+    def __init__(self, cube: pl.DataFrame):
+        self.rows = cube.height
+        self.labels = {}
+        self.codes = {}
+        self.postings = {}
+        indexed = cube.with_row_index('row_id')
+        for dim in FACET_DIMENSIONS:
+            # sort on the text form: encoded columns would otherwise come back in dictionary order
+            groups = indexed.group_by(dim).agg(c.row_id).sort(c(dim).cast(pl.String))
+            labels = groups[dim].to_list()
+            self.labels[dim] = labels
+            self.postings[dim] = {label: np.asarray(ids, dtype=np.uint32)
+                                  for label, ids in zip(labels, groups['row_id'].to_list())}
+            codes = np.empty(self.rows, dtype=np.uint32)
+            for code, label in enumerate(labels):
+                codes[self.postings[dim][label]] = code
+            self.codes[dim] = codes
+
+    def rows_for(self, dim: str, values) -> np.ndarray | None:
+        postings = self.postings[dim]
+        selected = [postings[value] for value in values if value in postings]
+        if len(selected) == len(postings):
+            return None
+        if not selected:
+            return np.empty(0, dtype=np.uint32)
+        if len(selected) == 1:
+            return selected[0]
+        return np.sort(np.concatenate(selected))
+
+    def select(self, affiliated_group=ALL_VALUE, specialty_group=ALL_VALUE, ftc_group=ALL_VALUE,
+               date_start=None, date_end=None, drug_class_list=None, drug_name_list=None) -> np.ndarray | None:
+        # None means every row is still reachable
+        selections = []
+        if date_start and date_end:
+            start, end = as_date(date_start), as_date(date_end)
+            selections.append(self.rows_for('dos', [dos for dos in self.labels['dos'] if start <= dos <= end]))
+        for dim, value in (('affiliated', affiliated_group), ('is_special', specialty_group), ('is_ftc', ftc_group)):
+            if value != ALL_VALUE:
+                selections.append(self.rows_for(dim, [as_bool(value)]))
+        if drug_class_list:
+            selections.append(self.rows_for('drug_class', drug_class_list))
+        if drug_name_list:
+            selections.append(self.rows_for('generic_name', drug_name_list))
+        rows = None
+        for selected in sorted((s for s in selections if s is not None), key=len):
+            rows = selected if rows is None else np.intersect1d(rows, selected, assume_unique=True)
+            if not len(rows):
+                break
+        return rows
+
+    def options(self, dim: str, **filters) -> list:
+        rows = self.select(**filters)
+        if rows is None:
+            return list(self.labels[dim])
+        labels = self.labels[dim]
+        return [labels[code] for code in np.unique(self.codes[dim][rows])]
+
+
+class DatasetFacets:
+    # a FacetIndex per data set, so adding or replacing a data set only re-indexes its own cells
+    def __init__(self):
+        self.cube = None
+        self.versions = {}
+        self.segments = {}
+
+    def update(self, cube: pl.DataFrame, versions: dict[str, list]):
+        stale = [name for name, version in versions.items() if self.versions.get(name) != version]
+        segments = {name: index for name, index in self.segments.items() if name in versions and name not in stale}
+        for name in stale:
+            segments[name] = FacetIndex(cube.filter(c.dataset == name))
+        # swapped in whole so concurrent readers see either the old or the new set of segments
+        self.segments, self.versions, self.cube = segments, dict(versions), cube
+
+    def options(self, dim: str, data_set_list=None, **filters) -> list:
+        segments = self.segments
+        found = set()
+        for name in data_set_list or list(segments):
+            if name in segments:
+                found.update(segments[name].options(dim, **filters))
+        return sorted(found, key=str)
+
+
+_facets = DatasetFacets()
+_facets_lock = threading.Lock()
+
+
+def load_facets() -> DatasetFacets:
+    cube, versions = cube_snapshot()
+    with _facets_lock:
+        if _facets.cube is not cube:
+            _facets.update(cube, versions)
+        return _facets
+
+
+def facet_options(dim: str, **filters) -> list:
+    return load_facets().options(dim, **filters)
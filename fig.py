@@ -1,12 +1,15 @@
-from dash import Dash, html, dcc, callback, Output, Input
-import dash_bootstrap_components as dbc
 import polars as pl
 from config import *
 from polars import col as c
-import plotly.express as px
+import plotly.graph_objects as go
+import numpy as np
 import polars.selectors as cs
+from execution import collect
 
 def create_fig_card(id,title):
+    # dash is only needed by the app, not by the report workers or the API that share these builders
+    from dash import html, dcc
+    import dash_bootstrap_components as dbc
     return dbc.Card(
         dbc.CardBody([
             html.H4(title,className="fw-bold text-center", style={'color':MCCPDC_PRIMARY}),
@@ -15,11 +18,17 @@ def create_fig_card(id,title):
         ),className='rounded-4 shadow-lg border-0 mb-5'
     )
 
-def scatter_fig(data):
-    data = (
-        data
-        .group_by(c.generic_name, c.drug_class)
-        .agg(c.total.sum(), (c.total.sum() - c.mc_total.sum()).alias('diff'),c.rx_ct.sum(),c.mc_total.sum())
+def drug_totals(data: pl.LazyFrame) -> pl.LazyFrame:
+    # the per-drug rollup every panel starts from; class totals are derived from it, not rescanned
+    return data.group_by(c.generic_name, c.drug_class).agg(c.total.sum(), c.mc_total.sum(), c.rx_ct.sum())
+
+def class_totals(data: pl.LazyFrame) -> pl.LazyFrame:
+    return data.group_by(c.drug_class).agg(c.total.sum(), c.mc_total.sum(), c.rx_ct.sum())
+
+def scatter_data(drugs: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        drugs
+        .with_columns((c.total - c.mc_total).alias('diff'))
         .with_columns((c.diff / c.rx_ct).alias('avg_diff'))
         .filter(c.diff > 0)
         .filter(c.avg_diff > 0)
@@ -32,34 +41,68 @@ def scatter_fig(data):
         when avg_diff <5000 then 16
         else 32 end as size_normalized
         from self""")
-        .collect()
+        .select('generic_name', 'drug_class', 'total', 'diff', 'rx_ct', 'mc_total', 'avg_diff', 'size_normalized')
+        .sort('generic_name', 'drug_class')
     )
 
-
-    fig = px.scatter(data, y='total', x='diff', size='size_normalized', color='drug_class', log_x=True, log_y=True,
-                     hover_data={
-                         'generic_name': True,  # Show generic_name in hover data
-                         'avg_diff': ':$,.2f',  # Format avg_diff as .2f (two decimal places)
-                         'diff': True,  # Keep other fields unchanged
-                         'total': True},
-                     custom_data=['avg_diff', 'diff', 'total', 'generic_name', 'drug_class','rx_ct','mc_total'],
-                     height=400,
-                     color_discrete_map=COLOR_MAPPING
-                     )
-    template = (
-        "<b>Drug Name:</b> %{customdata[3]}<br>"
-        "<b>Drug Class:</b> %{customdata[4]}<br>"
-        "<b>Rx Count:</b> %{customdata[5]:,.0f}<br>"# Rename 'generic_name'
-        "<b>Total Charge:</b> %{customdata[2]:$,.0f}<br>"  # Rename and format 'total'
-        "<b>MCCPDC Total Charge:</b> %{customdata[6]:$,.0f}<br>"  # Rename and format 'total'
-        "<b>Total Charge Difference:</b> %{customdata[1]:$,.0f}<br>"  # Rename and format 'diff'
-        "<b>Average Difference Per Rx:</b> %{customdata[0]:$,.2f}<br>"  # Rename and format 'avg_diff'
-        "<extra></extra>"  # Hides the default trace info
+def reduce_points(points: pl.LazyFrame, max_points: int = SCATTER_MAX_POINTS,
+                  cells_per_decade: int = SCATTER_CELLS_PER_DECADE) -> pl.LazyFrame:
+    # the max_points largest-savings drugs stay exact; beyond them only the largest-savings drug of each
+    # cell of a log-log grid is drawn, which keeps the shape of the cloud with far fewer points
+    ranked = points.with_columns(c.diff.rank('ordinal', descending=True).alias('savings_rank'))
+    cells = ['cell_x', 'cell_y']
+    tail = (
+        ranked
+        .filter(c.savings_rank > max_points)
+        .with_columns((c.diff.log10() * cells_per_decade).floor().alias('cell_x'),
+                      (c.total.log10() * cells_per_decade).floor().alias('cell_y'))
+        .sort('savings_rank')
+        .unique(subset=cells, keep='first', maintain_order=True)
+        .drop(cells)
     )
+    return pl.concat([ranked.filter(c.savings_rank <= max_points), tail]).drop('savings_rank').sort('generic_name', 'drug_class')
+
+def scatter_points(drugs: pl.LazyFrame) -> pl.LazyFrame:
+    return reduce_points(scatter_data(drugs))
+
+def scatter_fig(data):
+    return scatter_plot(collect(scatter_points(drug_totals(data))))
+
+def scatter_plot(data: pl.DataFrame):
+    # one trace per drug class (as px would draw it) with numeric columns as numpy arrays, which plotly
+    # sends base64-encoded; the drug name rides in `text` and the class is written into the template.
+    # x and y double as the total and savings in the hover, so customdata only carries three columns;
+    # float32 is as precise as the source measures and half the bytes of float64.
+    trace = go.Scattergl if data.height >= SCATTER_WEBGL_MIN_POINTS else go.Scatter
+    max_size = data['size_normalized'].max() or 1
+    fig = go.Figure()
+    for (drug_class,), points in data.partition_by('drug_class', as_dict=True, maintain_order=True).items():
+        template = (
+            "<b>Drug Name:</b> %{text}<br>"
+            f"<b>Drug Class:</b> {drug_class}<br>"
+            "<b>Rx Count:</b> %{customdata[1]:,.0f}<br>"
+            "<b>Total Charge:</b> %{y:$,.0f}<br>"
+            "<b>MCCPDC Total Charge:</b> %{customdata[2]:$,.0f}<br>"
+            "<b>Total Charge Difference:</b> %{x:$,.0f}<br>"
+            "<b>Average Difference Per Rx:</b> %{customdata[0]:$,.2f}<br>"
+            "<extra></extra>"  # Hides the default trace info
+        )
+        fig.add_trace(trace(
+            x=points['diff'].to_numpy().astype(np.float32),
+            y=points['total'].to_numpy().astype(np.float32),
+            text=points['generic_name'].cast(pl.String).to_list(),
+            customdata=points.select(c.avg_diff, c.rx_ct, c.mc_total).cast(pl.Float32).to_numpy(),
+            mode='markers',
+            name=drug_class,
+            marker=dict(size=points['size_normalized'].to_numpy().astype(np.uint8), sizemode='area',
+                        sizeref=2 * max_size / 20 ** 2, color=COLOR_MAPPING.get(drug_class)),
+            hovertemplate=template,
+        ))
 
     fig.update_layout(
-        xaxis=dict(tickformat='$.2s'),
-        yaxis=dict(tickformat='$.2s'),
+        height=400,
+        xaxis=dict(type='log', tickformat='$.2s'),
+        yaxis=dict(type='log', tickformat='$.2s'),
         plot_bgcolor="ghostwhite",  # Set plot background color
         paper_bgcolor="white",  # Set outer paper background color
         xaxis_title="<b>MCCPDC Estimated Savings<b>",
@@ -68,21 +111,24 @@ def scatter_fig(data):
         showlegend=False,
         title = None
     )
-    fig.update_traces(hovertemplate=template)
     return fig
 
 
-def bar_total_pct_savings(data):
-    data = (
-        data
-        .group_by(c.drug_class)
-        .agg(c.total.sum(), (c.total.sum() - c.mc_total.sum()).alias('diff'), c.rx_ct.sum())
+def savings_data(classes: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        classes
+        .select(c.drug_class, c.total, (c.total - c.mc_total).alias('diff'), c.rx_ct)
         .with_columns((c.diff / c.rx_ct).alias('avg_diff'))
         .filter(c.diff > 0)
         .with_columns((c.diff / c.diff.sum()).alias('diff_pct'))
         .sort(by='diff_pct', descending=True)
-        .collect()
     )
+
+def bar_total_pct_savings(data):
+    return savings_plot(collect(savings_data(class_totals(data))))
+
+def savings_plot(data: pl.DataFrame):
+    import plotly.express as px  # ~0.2s to import; deferred to the first render (the warm-up, when serving)
     fig = px.bar(data,
                  y='drug_class',
                  x='diff_pct',
@@ -108,7 +154,7 @@ def bar_total_pct_savings(data):
         "<b>Average Difference Per Rx:</b> %{customdata[0]:$,.2f}<br>"  # Rename and format 'avg_diff'
         "<extra></extra>"  # Hides the default trace info
     )
-    max_x = data.select(c.diff_pct.max()).item()
+    max_x = data.select(c.diff_pct.max()).item() or 0
     fig.update_traces(
         texttemplate='%{text:.1%}',
         textposition='outside',
@@ -127,18 +173,22 @@ def bar_total_pct_savings(data):
     return fig
 
 
-def avg_charge_per_rx(data):
-    data = (
-        data
-        .group_by(c.drug_class)
-        .agg(c.total.sum(), c.mc_total.sum(), (c.total.sum() - c.mc_total.sum()).alias('diff'), c.rx_ct.sum())
+def avg_charge_data(classes: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        classes
+        .with_columns((c.total - c.mc_total).alias('diff'))
         .with_columns((c.diff / c.rx_ct).alias('avg_diff'))
         .filter(c.diff > 0)
         .with_columns((c.diff / c.diff.sum()).alias('diff_pct'))
         .with_columns((c.total / c.rx_ct).alias('avg_charge'), (c.mc_total / c.rx_ct).alias('mc_avg_charge'))
         .sort(by='diff_pct', descending=True)
-        .collect()
     )
+
+def avg_charge_per_rx(data):
+    return avg_charge_plot(collect(avg_charge_data(class_totals(data))))
+
+def avg_charge_plot(data: pl.DataFrame):
+    import plotly.express as px
     data = data.unpivot(index='drug_class', on=['avg_charge', 'mc_avg_charge']).sort(by=['variable', 'value'])
     fig = px.bar(data,
                  y='variable',
@@ -180,3 +230,51 @@ def avg_charge_per_rx(data):
         )
     )
     return fig
+
+
+def trend_plot(data: pl.DataFrame):
+    # monthly savings as bars, the trailing-window average as a line; both come straight from the
+    # prefix sums (timeseries.monthly), so there is nothing left to aggregate here
+    months = data['month'].to_list()
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=months,
+        y=data['savings'].to_numpy(),
+        customdata=data.select(c.total, c.mc_total, c.rx_ct, c.savings_pct).to_numpy(),
+        name='Estimated Savings',
+        marker_color=MCCPDC_PRIMARY,
+        hovertemplate=(
+            "<b>%{x|%b %Y}</b><br>"
+            "<b>Estimated Savings:</b> %{y:$,.0f}<br>"
+            "<b>Savings Percent:</b> %{customdata[3]:.1%}<br>"
+            "<b>Total Charge:</b> %{customdata[0]:$,.0f}<br>"
+            "<b>MCCPDC Total Charge:</b> %{customdata[1]:$,.0f}<br>"
+            "<b>Rx Count:</b> %{customdata[2]:,.0f}<br>"
+            "<extra></extra>"
+        ),
+    ))
+    fig.add_trace(go.Scatter(
+        x=months,
+        y=data['rolling_savings'].to_numpy(),
+        customdata=data.select(c.rolling_savings_pct, c.rolling_savings_per_rx).to_numpy(),
+        name=f'{TREND_ROLLING_MONTHS}-Month Average',
+        mode='lines+markers',
+        line=dict(color=MCCPDC_ACCENT, width=3),
+        hovertemplate=(
+            f"<b>{TREND_ROLLING_MONTHS}-Month Average:</b> %{{y:$,.0f}}<br>"
+            "<b>Savings Percent:</b> %{customdata[0]:.1%}<br>"
+            "<b>Savings Per Rx:</b> %{customdata[1]:$,.2f}<br>"
+            "<extra></extra>"
+        ),
+    ))
+    fig.update_layout(
+        height=400,
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+        xaxis=dict(tickformat='%b %Y', dtick='M3'),
+        yaxis=dict(tickformat='$.2s', title='<b>MCCPDC Estimated Savings<b>'),
+        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='right', x=1),
+        hovermode='x unified',
+        title=None,
+    )
+    return fig
@@ -0,0 +1,44 @@
+# production serving: gunicorn -c gunicorn.conf.py
+# The master ingests and publishes the cube once (in a subprocess, so polars never initializes before
+# the fork); every worker then memory-maps the same Arrow file instead of loading its own copy.
+# /metrics can be scraped through the shared port: each worker snapshots its metrics into
+# MC_METRICS_DIR and whichever worker answers serves the total over all of them. Gauges carry a
+# worker label. /metrics/slow-queries is still per worker.
+import multiprocessing
+import os
+import subprocess
+import sys
+
+wsgi_app = 'app:server'
+bind = os.environ.get('MC_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('MC_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('MC_THREADS', 4))
+timeout = int(os.environ.get('MC_TIMEOUT', 120))
+preload_app = False
+
+# set before anything imports config: the workers fork from the master with its config module loaded
+os.environ.setdefault('MC_METRICS_DIR', os.path.join(os.environ.get('MC_CACHE_DIR', 'cache'), 'metrics'))
+
+
+def on_starting(server):
+    subprocess.run([sys.executable, 'ingest.py'], check=True)
+    subprocess.run([sys.executable, 'cube.py'], check=True)
+    from config import CACHE_DIR, METRICS_DIR
+    import json
+    import shutil
+    # counters start over with the server, like any process restart
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    version = json.loads((CACHE_DIR / 'cube.json').read_text())['fingerprint']
+    os.environ['MC_DATA_VERSION'] = version
+    server.log.info('published data version %s', version)
+
+
+def post_worker_init(worker):
+    # data sets may have been hot-reloaded since startup, so a respawned worker checks against what is
+    # published now rather than what the master saw
+    from cube import data_version, published_version
+    expected = published_version() or os.environ.get('MC_DATA_VERSION')
+    if data_version() != expected:
+        worker.log.error('worker %s loaded data version %s, expected %s', worker.pid, data_version(), expected)
+        sys.exit(3)  # gunicorn's WORKER_BOOT_ERROR: the arbiter stops instead of respawning forever
+    worker.log.info('worker %s serving data version %s', worker.pid, expected)
@@ -0,0 +1,124 @@
+from config import *
+from urllib.parse import quote
+import argparse
+import json
+import os
+import shutil
+import polars as pl
+from calc import *
+from execution import sink_parquet, source_bytes, use_streaming
+from sampling import remove_sample, sample_path, write_sample
+
+PARTITION_KEYS = ['year', 'month']
+INGEST_TMP_DIR = CACHE_DIR / 'ingest-tmp'
+INGEST_LOCK = CACHE_DIR / 'ingest.lock'
+ROW_GROUP_SIZE = 16_384
+
+
+def write_manifest(manifest: dict):
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = STORE_MANIFEST.with_suffix('.tmp')
+    tmp.write_text(json.dumps(manifest, indent=2))
+    tmp.replace(STORE_MANIFEST)
+
+
+def stream_partitions(source: pl.LazyFrame, tmp_dir: Path, input_bytes: int) -> int:
+    # for files too big for memory: one out-of-core sort into a scratch file, then each month is cut
+    # from it through row-group statistics, so no step holds the whole data set
+    tmp_dir.mkdir(parents=True)
+    ordered = tmp_dir / 'sorted.parquet'
+    sink_parquet(source.with_columns(enrich(streamable=True)).sort(PARTITION_KEYS + SORT_KEYS), ordered, input_bytes,
+                 row_group_size=ROW_GROUP_SIZE)
+    months = collect(pl.scan_parquet(ordered).select(PARTITION_KEYS).unique().sort(PARTITION_KEYS), input_bytes)
+    for year, month in months.iter_rows():
+        part_dir = tmp_dir / f'year={year}' / f'month={month}'
+        part_dir.mkdir(parents=True)
+        part = pl.scan_parquet(ordered).filter((c.year == year) & (c.month == month)).drop(PARTITION_KEYS)
+        sink_parquet(part, part_dir / 'part-0.parquet', input_bytes, statistics=True, row_group_size=ROW_GROUP_SIZE)
+    rows = pl.scan_parquet(ordered).select(pl.len()).collect().item()
+    ordered.unlink()
+    return rows
+
+
+def process_tmp_dir() -> Path:
+    # scratch space of this process only; another one's may still hold output it is about to publish
+    return INGEST_TMP_DIR / str(os.getpid())
+
+
+def write_dataset(file: str) -> int:
+    source = pl.scan_parquet(DATA_DIR / f'{file}.parquet')
+    input_bytes = source_bytes([file])
+    tmp_dir = process_tmp_dir() / quote(file, safe='')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if use_streaming(input_bytes):
+        rows = stream_partitions(source, tmp_dir, input_bytes)
+    else:
+        data = source.with_columns(enrich()).sort(PARTITION_KEYS + SORT_KEYS).collect()
+        for (year, month), part in data.partition_by(PARTITION_KEYS, as_dict=True, maintain_order=True).items():
+            part_dir = tmp_dir / f'year={year}' / f'month={month}'
+            part_dir.mkdir(parents=True)
+            part.drop(PARTITION_KEYS).write_parquet(part_dir / 'part-0.parquet', statistics=True,
+                                                    row_group_size=ROW_GROUP_SIZE)
+        rows = data.height
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    # renamed out of the way rather than deleted in place, so the old partitions are never half gone
+    old_dir = tmp_dir.with_name(tmp_dir.name + '.old')
+    if dataset_dir(file).exists():
+        dataset_dir(file).replace(old_dir)
+    tmp_dir.replace(dataset_dir(file))
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return rows
+
+
+def remove_dataset(file: str):
+    shutil.rmtree(dataset_dir(file), ignore_errors=True)
+    remove_sample(file)
+
+
+def ingest(files: list[str] | None = None, force: bool = False) -> dict[str, int]:
+    # every worker's registry sees the same new file; the first to get the lock ingests it and the rest
+    # find the manifest already current. The manifest and dictionaries are read inside the lock, so no
+    # process writes back a stale copy over another's.
+    with file_lock(INGEST_LOCK):
+        try:
+            return ingest_locked(files, force)
+        finally:
+            shutil.rmtree(process_tmp_dir(), ignore_errors=True)
+
+
+def ingest_locked(files: list[str] | None, force: bool) -> dict[str, int]:
+    manifest = read_manifest()
+    enrichment = enrichment_fingerprint()
+    if manifest['enrichment'] != enrichment:
+        manifest = {'enrichment': enrichment, 'datasets': {}}
+        force = True
+    files = get_files() if files is None else [file for file in files if not dataset_problems(file)]
+    extend_dictionaries(files, persist=True)
+    written = {}
+    for file in files:
+        if not force and manifest['datasets'].get(file) == file_fingerprint(file):
+            # stores written before the samples existed only need the sample drawn
+            if not sample_path(file).exists():
+                write_sample(file)
+            continue
+        if manifest['datasets'].pop(file, None) is not None:
+            # readers fall back to the source file while its partitions are swapped
+            write_manifest(manifest)
+        written[file] = write_dataset(file)
+        write_sample(file)
+        manifest['datasets'][file] = file_fingerprint(file)
+    for file in set(manifest['datasets']) - set(get_files()):
+        remove_dataset(file)
+        del manifest['datasets'][file]
+    write_manifest(manifest)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enrich PBM data sets into the partitioned parquet store.')
+    parser.add_argument('files', nargs='*', help='data set names (file stems in DATA_DIR); defaults to all')
+    parser.add_argument('--force', action='store_true', help='rewrite data sets even if unchanged')
+    args = parser.parse_args()
+    for file, rows in ingest(args.files or None, force=args.force).items():
+        print(f'{file}: {rows:,} rows')
+    print(f'store at {STORE_DIR} is current')
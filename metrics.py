@@ -0,0 +1,292 @@
+from config import *
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import atexit
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+slow_logger = logging.getLogger('mc.slow_queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+BYTE_BUCKETS = (1_000, 10_000, 100_000, 500_000, 1_000_000, 5_000_000, 20_000_000)
+
+
+class Metric:
+    def __init__(self, name: str, help: str, kind: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def label_text(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def header(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self) -> list[str]:
+        return self.lines(self.snapshot_values())
+
+    @staticmethod
+    def key(labels) -> tuple:
+        # label pairs come back from a JSON snapshot as lists
+        return tuple(tuple(pair) for pair in labels)
+
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, 'counter')
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot_values(self) -> dict:
+        with self._lock:
+            return dict(self.values)
+
+    def merge(self, values: dict, snapshot: list, worker: str):
+        for labels, value in snapshot:
+            key = self.key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def lines(self, values: dict) -> list[str]:
+        return self.header() + [f'{self.name}{self.label_text(key)} {value}' for key, value in values.items()]
+
+
+class Gauge(Metric):
+    # read at scrape time from a callable, so nothing has to keep it up to date
+    def __init__(self, name: str, help: str, read):
+        super().__init__(name, help, 'gauge')
+        self.read = read
+
+    def snapshot_values(self) -> dict:
+        return {(): self.read()}
+
+    def merge(self, values: dict, snapshot: list, worker: str):
+        # a process's own level, so each worker's is kept apart rather than summed
+        for labels, value in snapshot:
+            values[self.key(labels) + (('worker', worker),)] = value
+
+    def lines(self, values: dict) -> list[str]:
+        return self.header() + [f'{self.name}{self.label_text(key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    def __init__(self, name: str, help: str, buckets: tuple):
+        super().__init__(name, help, 'histogram')
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def snapshot_values(self) -> dict:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+    def merge(self, values: dict, snapshot: list, worker: str):
+        for labels, (counts, total) in snapshot:
+            key = self.key(labels)
+            merged, merged_total = values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            values[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+
+    def lines(self, values: dict) -> list[str]:
+        lines = self.header()
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.label_text(key + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{self.label_text(key)} {total}')
+            lines.append(f'{self.name}_count{self.label_text(key)} {cumulative}')
+        return lines
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+CALLBACK_SECONDS = register(Histogram('dash_callback_duration_seconds', 'Wall time of Dash callbacks.', LATENCY_BUCKETS))
+CALLBACK_ERRORS = register(Counter('dash_callback_errors_total', 'Dash callbacks that raised.'))
+CALLBACK_ROWS_SCANNED = register(Histogram('dash_callback_rows_scanned', 'Source rows scanned per callback.', ROW_BUCKETS))
+CALLBACK_RESULT_ROWS = register(Histogram('dash_callback_result_rows', 'Filtered rows per callback.', ROW_BUCKETS))
+CALLBACK_PHASE_SECONDS = register(Histogram('dash_callback_phase_seconds', 'Time per phase (query, aggregate, render) inside callbacks.', LATENCY_BUCKETS))
+REQUEST_SECONDS = register(Histogram('dash_request_duration_seconds', 'Callback HTTP requests including Dash serialization.', LATENCY_BUCKETS))
+RESPONSE_BYTES = register(Histogram('dash_response_bytes', 'Serialized callback response size.', BYTE_BUCKETS))
+FIGURE_BYTES = register(Histogram('dash_figure_bytes', 'Serialized size of each figure output.', BYTE_BUCKETS))
+QUERY_SECONDS = register(Histogram('query_duration_seconds', 'Filtered scans run by the query layer.', LATENCY_BUCKETS))
+QUERY_CACHE = register(Counter('query_cache_requests_total', 'Query cache lookups by result.'))
+
+_call = ContextVar('mc_callback_stats', default=None)
+SLOW_QUERIES = deque(maxlen=METRICS_SLOW_QUERY_KEEP)
+
+
+def record_scan(source_rows: int, result_rows: int):
+    # called by the query layer; attributed to whichever callback is running on this thread
+    stats = _call.get()
+    if stats is not None:
+        stats['rows_scanned'] += source_rows
+        stats['result_rows'] += result_rows
+
+
+@contextmanager
+def phase(name: str):
+    stats = _call.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            CALLBACK_PHASE_SECONDS.observe(time.perf_counter() - started, callback=stats['callback'], phase=name)
+
+
+def record_slow_query(filters: dict, seconds: float, profile=None):
+    if random.random() >= METRICS_SLOW_QUERY_SAMPLE_RATE:
+        return
+    entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': round(seconds, 4), 'filters': filters}
+    if profile is not None:
+        entry['profile'] = profile.to_dicts()
+    SLOW_QUERIES.append(entry)
+    slow_logger.warning('slow query %.3fs %s', seconds, json.dumps(entry, default=str))
+
+
+def instrument(name: str):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = {'callback': name, 'rows_scanned': 0, 'result_rows': 0}
+            token = _call.set(stats)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                # PreventUpdate is flow control, not a failure
+                if type(error).__name__ != 'PreventUpdate':
+                    CALLBACK_ERRORS.inc(callback=name)
+                raise
+            finally:
+                _call.reset(token)
+                CALLBACK_SECONDS.observe(time.perf_counter() - started, callback=name)
+                CALLBACK_ROWS_SCANNED.observe(stats['rows_scanned'], callback=name)
+                CALLBACK_RESULT_ROWS.observe(stats['result_rows'], callback=name)
+        return wrapper
+    return decorator
+
+
+def render_metrics() -> str:
+    if METRICS_DIR is not None:
+        return render_workers()
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+# ---- several worker processes -------------------------------------------------------------------
+# under gunicorn a scrape reaches whichever worker accepts it, and each only counts its own requests.
+# With METRICS_DIR set every worker writes its values there, and /metrics serves the sum over all of
+# them, so any worker answers with the same monotonic totals. Workers that have exited keep their
+# snapshot (their counts still happened); their gauges are dropped.
+
+WORKER_ID = f'{os.getpid()}-{time.time_ns()}'
+
+
+def write_snapshot():
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    snapshot = {metric.name: [[key, value] for key, value in metric.snapshot_values().items()] for metric in REGISTRY}
+    path = METRICS_DIR / f'{WORKER_ID}.json'
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(snapshot, default=str))
+    tmp.replace(path)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render_workers() -> str:
+    write_snapshot()
+    merged = {metric.name: {} for metric in REGISTRY}
+    for path in METRICS_DIR.glob('*.json'):
+        try:
+            snapshot = json.loads(path.read_text())
+        except (OSError, ValueError):  # removed or replaced while reading
+            continue
+        pid = path.stem.split('-')[0]
+        alive = process_alive(int(pid))
+        for metric in REGISTRY:
+            if metric.name in snapshot and (alive or metric.kind != 'gauge'):
+                metric.merge(merged[metric.name], snapshot[metric.name], pid)
+    return '\n'.join(line for metric in REGISTRY for line in metric.lines(merged[metric.name])) + '\n'
+
+
+def start_snapshots():
+    def run():
+        while True:
+            time.sleep(METRICS_SNAPSHOT_SECONDS)
+            try:
+                write_snapshot()
+            except OSError:
+                logging.getLogger('mc.metrics').exception('metrics snapshot failed')
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+    atexit.register(write_snapshot)
+
+
+def register_metrics(server):
+    from flask import Response, g, request
+
+    if METRICS_DIR is not None:
+        start_snapshots()
+
+    @server.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @server.after_request
+    def record_response_size(response):
+        if request.path.endswith('_dash-update-component') and response.status_code == 200:
+            body = request.get_json(silent=True) or {}
+            output = body.get('output', '')
+            # request time minus the callback's own time is what Dash spends serializing the outputs
+            REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_started, output=output)
+            RESPONSE_BYTES.observe(response.content_length or 0, output=output)
+            # figure sizes need the payload parsed, so only a sample of responses pays for it
+            if random.random() < METRICS_PAYLOAD_SAMPLE_RATE:
+                payload = json.loads(response.get_data()).get('response', {})
+                for component, props in payload.items():
+                    if 'figure' in props:
+                        FIGURE_BYTES.observe(len(json.dumps(props['figure'])), figure=component)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics/slow-queries')
+    def slow_queries():
+        return Response(json.dumps(list(SLOW_QUERIES), default=str), mimetype='application/json')
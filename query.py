@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from config import *
+import hashlib
+import json
+import threading
+import time
+import polars as pl
+from calc import ALL_VALUE, as_bool, filter_data
+from execution import collect
+from metrics import QUERY_CACHE, QUERY_SECONDS, Gauge, record_scan, record_slow_query, register
+from timeseries import load_timeseries
+
+FILTER_ARGS = ('data_set_list', 'affiliated_group', 'specialty_group', 'ftc_group', 'date_start', 'date_end',
+               'drug_class_list', 'drug_name_list')
+LIST_ARGS = ('data_set_list', 'drug_class_list', 'drug_name_list')
+TOGGLE_ARGS = ('affiliated_group', 'specialty_group', 'ftc_group')
+
+
+def canonical_filters(**filters) -> dict:
+    # empty multi-selects mean "no filter", selection order never changes the result, and
+    # 'true' / True are the same toggle state
+    state = {}
+    for arg in FILTER_ARGS:
+        value = filters.get(arg)
+        if isinstance(value, (list, tuple)):
+            value = sorted(value, key=str) or None
+        elif arg in TOGGLE_ARGS:
+            value = ALL_VALUE if value in (None, ALL_VALUE) else as_bool(value)
+        state[arg] = value
+    if not (state['date_start'] and state['date_end']):
+        state['date_start'] = state['date_end'] = None
+    else:
+        state['date_start'], state['date_end'] = state['date_start'][:10], state['date_end'][:10]
+    return state
+
+
+def refines(state: dict, parent: dict) -> bool:
+    # True when every row matching `state` also matches `parent`, i.e. state is a drill-down of parent
+    for arg in LIST_ARGS:
+        if parent[arg] is not None and (state[arg] is None or not set(state[arg]) <= set(parent[arg])):
+            return False
+    for arg in TOGGLE_ARGS:
+        if parent[arg] != ALL_VALUE and state[arg] != parent[arg]:
+            return False
+    if parent['date_start'] is not None:
+        if state['date_start'] is None:
+            return False
+        if not (parent['date_start'] <= state['date_start'] and state['date_end'] <= parent['date_end']):
+            return False
+    return True
+
+
+def filter_key(**filters) -> str:
+    state = canonical_filters(**filters)
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FrameCache:
+    # LRU of materialized frames, bounded by entry count and by estimated size in bytes
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._meta = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str) -> pl.DataFrame | None:
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def entries(self) -> list[tuple[dict, pl.DataFrame]]:
+        with self._lock:
+            return [(self._meta.get(key), frame) for key, frame in self._frames.items()]
+
+    def put(self, key: str, frame: pl.DataFrame, meta: dict | None = None, generation: int | None = None):
+        size = frame.estimated_size()
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return  # computed from data that was replaced while the query ran
+            if key in self._frames:
+                self._bytes -= self._frames.pop(key).estimated_size()
+            if size > self.max_bytes:
+                return
+            self._frames[key] = frame
+            self._meta[key] = meta
+            self._bytes += size
+            while len(self._frames) > self.max_entries or self._bytes > self.max_bytes:
+                evicted_key, evicted = self._frames.popitem(last=False)
+                self._meta.pop(evicted_key, None)
+                self._bytes -= evicted.estimated_size()
+
+    def get_or_compute(self, key: str, compute, meta: dict | None = None) -> pl.DataFrame:
+        frame = self.get(key)
+        if frame is not None:
+            return frame
+        # callbacks fired by the same control change arrive together; only the first one scans
+        with self._lock:
+            key_lock = self._pending.setdefault(key, threading.Lock())
+            generation = self._generation
+        with key_lock:
+            frame = self.get(key)
+            if frame is None:
+                frame = compute()
+                self.put(key, frame, meta, generation)
+        with self._lock:
+            self._pending.pop(key, None)
+        return frame
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._frames.clear()
+            self._meta.clear()
+            self._bytes = 0
+
+
+FRAME_CACHE = FrameCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES)
+register(Gauge('query_cache_entries', 'Frames held by the query cache.', lambda: len(FRAME_CACHE)))
+register(Gauge('query_cache_bytes', 'Estimated size of the frames held by the query cache.', lambda: FRAME_CACHE.nbytes))
+
+
+def cached_parent(state: dict) -> pl.DataFrame | None:
+    # the smallest cached frame whose filter state contains this one. Cached frames have their months
+    # summed away, so only a parent over the same dates can be narrowed further.
+    parents = [frame for meta, frame in FRAME_CACHE.entries()
+               if meta is not None and refines(state, meta)
+               and (meta['date_start'], meta['date_end']) == (state['date_start'], state['date_end'])]
+    return min(parents, key=lambda frame: frame.height, default=None)
+
+
+def run_query(state: dict, outcome: list) -> pl.DataFrame:
+    # a narrowed filter is answered from the cached frame it narrows; anything else, whatever its dates,
+    # is a difference of two prefix-sum columns per dimension combination rather than a cube scan
+    source = cached_parent(state)
+    outcome.append('miss' if source is None else 'refine')
+    started = time.perf_counter()
+    plan = None
+    if source is None:
+        index = load_timeseries()
+        frame = index.range_frame(**state)
+        scanned = index.combos.height
+    else:
+        plan = filter_data(**{**state, 'date_start': None, 'date_end': None}, data=source.lazy())
+        frame = collect(plan, source.estimated_size())
+        scanned = source.height
+    seconds = time.perf_counter() - started
+    QUERY_SECONDS.observe(seconds)
+    record_scan(scanned, 0)
+    if seconds >= METRICS_SLOW_QUERY_SECONDS:
+        profile = profile_plan(plan) if plan is not None and METRICS_PROFILE_SLOW_QUERIES else None
+        record_slow_query(state, seconds, profile)
+    return frame
+
+
+def profile_plan(plan: pl.LazyFrame) -> pl.DataFrame | None:
+    # polars refuses to profile a plan with no operators (an unfiltered slice), there is nothing to time
+    try:
+        return plan.profile()[1]
+    except pl.exceptions.ComputeError:
+        return None
+
+
+def query_data(**filters) -> pl.LazyFrame:
+    # consumers get a lazy view over the shared materialized frame, so figure builders stay unchanged;
+    # the frame is the rollup cube's slice with its months summed away (from the prefix sums, or from a
+    # cached parent), never the row-level files
+    state = canonical_filters(**filters)
+    outcome = []
+    frame = FRAME_CACHE.get_or_compute(filter_key(**state), lambda: run_query(state, outcome), meta=state)
+    QUERY_CACHE.inc(result=outcome[0] if outcome else 'hit')
+    record_scan(0, frame.height)
+    return frame.lazy()
@@ -0,0 +1,62 @@
+from config import *
+import hashlib
+import threading
+import time
+import polars as pl
+
+
+class ReferenceList:
+    # one product list kept in memory; the file is only re-read when its mtime/size change,
+    # and the version only moves when the content hash does
+    def __init__(self, path: Path, column: str = 'product'):
+        self.path = path
+        self.column = column
+        self.version = None
+        self._stat = None
+        self._checked = 0.0
+        self._series = None
+        self._set = frozenset()
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        now = time.monotonic()
+        if not force and self._series is not None and now - self._checked < REFERENCE_CHECK_INTERVAL:
+            return False
+        with self._lock:
+            self._checked = now
+            stat = self.path.stat()
+            stat = (stat.st_mtime_ns, stat.st_size)
+            if not force and stat == self._stat:
+                return False
+            self._stat = stat
+            content = self.path.read_bytes()
+            version = hashlib.sha1(content).hexdigest()[:12]
+            if version == self.version:
+                return False
+            series = pl.read_parquet(self.path, columns=[self.column]).to_series().unique().sort()
+            self._series, self._set, self.version = series, frozenset(series.to_list()), version
+            return True
+
+    @property
+    def values(self) -> pl.Series:
+        self.refresh()
+        return self._series
+
+    def __contains__(self, product: str) -> bool:
+        self.refresh()
+        return product in self._set
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._set)
+
+
+SPECIALTY_LIST = ReferenceList(SPECIALTY_DIR / 'specialty_list.parquet')
+FTC_LIST = ReferenceList(SPECIALTY_DIR / 'ftc_product.parquet')
+
+
+def reference_version() -> str:
+    # content-based, so a touched-but-unchanged file doesn't invalidate the store or the cube
+    SPECIALTY_LIST.refresh()
+    FTC_LIST.refresh()
+    return f'{SPECIALTY_LIST.version}-{FTC_LIST.version}'
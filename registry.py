@@ -0,0 +1,100 @@
+from config import *
+import logging
+import threading
+import time
+from calc import dataset_problems, dataset_version, list_files
+from cube import cube_snapshot, update_cube
+from facets import load_facets
+from ingest import ingest
+from query import FRAME_CACHE
+from timeseries import load_timeseries
+
+logger = logging.getLogger('mc.registry')
+
+
+class DatasetRegistry:
+    # polls DATA_DIR and folds added, replaced and removed data sets into the store, the cube, the
+    # facet index and the query cache, touching only the data sets that changed
+    def __init__(self, interval: float = REGISTRY_POLL_SECONDS):
+        self.interval = interval
+        self.versions = dict(cube_snapshot()[1])
+        self.rejected = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def datasets(self) -> list[str]:
+        return sorted(self.versions)
+
+    def file_stats(self) -> dict[str, tuple]:
+        stats = {}
+        for file in list_files():
+            try:
+                stat = (DATA_DIR / f'{file}.parquet').stat()
+            except FileNotFoundError:  # removed between the listing and the stat
+                continue
+            stats[file] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def poll(self) -> tuple[list[str], list[str]]:
+        with self._lock:
+            stats = self.file_stats()
+            # a file still being copied in changes between polls; wait until it has settled
+            settled = [file for file, stat in stats.items() if self._stats.get(file) == stat]
+            self._stats = stats
+            self.rejected = {file: version for file, version in self.rejected.items() if file in stats}
+            changed = []
+            for file in settled:
+                version = dataset_version(file)
+                if version in (self.versions.get(file), self.rejected.get(file)):
+                    continue
+                if dataset_problems(file):
+                    # logged by dataset_problems; get_files leaves it out everywhere else too
+                    self.rejected[file] = version
+                else:
+                    changed.append(file)
+            removed = [file for file in self.versions if file not in stats]
+            if changed or removed:
+                self.apply(changed, removed)
+            return changed, removed
+
+    def apply(self, changed: list[str], removed: list[str]):
+        started = time.perf_counter()
+        ingest(changed)
+        update_cube(changed, removed)
+        FRAME_CACHE.clear()
+        load_facets()
+        load_timeseries()
+        self.versions = dict(cube_snapshot()[1])
+        for file in changed + removed:
+            self.rejected.pop(file, None)
+        logger.info('data sets updated in %.2fs: changed %s, removed %s', time.perf_counter() - started,
+                    changed, removed)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                # leave the versions alone so the next poll retries
+                logger.exception('data set refresh failed')
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='dataset-registry', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+_registry = None
+
+
+def load_registry() -> DatasetRegistry:
+    global _registry
+    if _registry is None:
+        _registry = DatasetRegistry().start()
+    return _registry
@@ -0,0 +1,237 @@
+from config import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from html import escape
+from itertools import product
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import polars as pl
+
+try:
+    import resource
+except ImportError:  # Windows: no per-process address-space limit
+    resource = None
+
+REPORT_TEMPLATE = '''<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 2rem; color: {primary}; }}
+table {{ border-collapse: collapse; margin-bottom: 2rem; }}
+td, th {{ padding: .4rem 1rem; border-bottom: 1px solid #ddd; text-align: right; }}
+th {{ text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<p>{filters}</p>
+<table>{kpis}</table>
+{figures}
+</body>
+</html>
+'''
+KPI_LABELS = {'total': ('Total', '${:,.0f}'), 'mc_total': ('MCCPDC', '${:,.0f}'), 'rx_ct': ('Rx Ct', '{:,}'),
+              'mc_diff': ('Estimated Savings', '${:,.0f}'), 'per_rx': ('Savings Per Rx', '${:,.2f}'),
+              'diff_pct': ('Savings Percent', '{:,.0%}')}
+# filter columns of the KPI tables: toggles are null for All, list filters are JSON and null when unset
+SCENARIO_SCHEMA = {'data_set_list': pl.String, 'affiliated_group': pl.Boolean, 'specialty_group': pl.Boolean,
+                   'ftc_group': pl.Boolean, 'date_start': pl.Date, 'date_end': pl.Date, 'drug_class_list': pl.String,
+                   'drug_name_list': pl.String}
+FIGURE_TITLES = {'scatter': 'Total PBM Charge to Employers vs. MCCPDC Estimated Savings',
+                 'savings': 'MCCPDC % Savings vs PBMs by Drug Class',
+                 'avg_charge': 'Average Charge Per Rx by Drug Class',
+                 'trend': 'Monthly MCCPDC Estimated Savings'}
+
+
+# ---- scenarios ------------------------------------------------------------------------------
+
+def toggle(value: str):
+    # an argparse type: a bad value is reported as a usage error rather than a KeyError traceback
+    try:
+        return {'all': 'All', 'true': True, 'false': False}[value.lower()]
+    except KeyError:
+        raise argparse.ArgumentTypeError('expected all, true or false') from None
+
+
+def scenario_grid(datasets: list[list[str] | None], affiliated: list, specialty: list, ftc: list,
+                  date_start: str, date_end: str) -> list[dict]:
+    return [
+        dict(data_set_list=data_set_list, affiliated_group=affiliated_group, specialty_group=specialty_group,
+             ftc_group=ftc_group, date_start=date_start, date_end=date_end, drug_class_list=None, drug_name_list=None)
+        for data_set_list, affiliated_group, specialty_group, ftc_group in product(datasets, affiliated, specialty, ftc)
+    ]
+
+
+def load_scenarios(path: Path) -> list[dict]:
+    # checked and completed like KPI API scenarios: every filter argument present, toggles as booleans or
+    # 'All', and a bad entry stops the run before any worker starts
+    from api import ScenarioError, parse_scenario
+    specs = json.loads(path.read_text())
+    if not isinstance(specs, list):
+        raise SystemExit(f'{path}: expected a list of scenarios')
+    scenarios = []
+    for index, spec in enumerate(specs):
+        try:
+            scenarios.append(parse_scenario(spec)[1])
+        except ScenarioError as error:
+            raise SystemExit(f'{path}: scenario {index}: {error}')
+    return scenarios
+
+
+def scenario_columns(scenario: dict) -> dict:
+    columns = {}
+    for arg, value in scenario.items():
+        if value is None or value == 'All':
+            columns[arg] = None
+        elif isinstance(value, list):
+            columns[arg] = json.dumps(value)
+        elif arg.startswith('date_'):
+            columns[arg] = date.fromisoformat(value[:10])
+        else:
+            columns[arg] = value
+    return columns
+
+
+def scenario_name(scenario: dict) -> str:
+    parts = [', '.join(scenario['data_set_list']) if scenario['data_set_list'] else 'All data sets']
+    for arg, label in (('affiliated_group', 'affiliated'), ('specialty_group', 'specialty'), ('ftc_group', 'FTC')):
+        if scenario[arg] != 'All':
+            parts.append(label if scenario[arg] else f'non-{label}')
+    if scenario.get('drug_class_list'):
+        parts.append(', '.join(scenario['drug_class_list']))
+    return ' / '.join(parts)
+
+
+def slug(text: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')[:80]
+
+
+# ---- workers --------------------------------------------------------------------------------
+
+def limit_memory(limit_bytes: int | None):
+    # a runaway scenario kills its own worker (MemoryError) instead of the whole batch host
+    if limit_bytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+
+def render_report(path: Path, scenario: dict, kpis: dict, figures: dict, include_plotlyjs):
+    rows = ''.join(f'<tr><th>{label}</th><td>{fmt.format(kpis[key][0] or 0)}</td></tr>'
+                   for key, (label, fmt) in KPI_LABELS.items())
+    blocks = []
+    for panel, title in FIGURE_TITLES.items():
+        html = figures[panel].to_html(full_html=False, include_plotlyjs=include_plotlyjs if not blocks else False)
+        blocks.append(f'<h2>{escape(title)}</h2>{html}')
+    filters = f"{scenario['date_start']} to {scenario['date_end']}" if scenario['date_start'] else 'All dates'
+    path.write_text(REPORT_TEMPLATE.format(title=escape(scenario_name(scenario)), filters=escape(filters), kpis=rows,
+                                           figures='\n'.join(blocks), primary=MCCPDC_PRIMARY))
+
+
+def run_group(data_set_list: list[str] | None, scenarios: list[tuple[int, dict]], out_dir: Path,
+              include_plotlyjs) -> list[dict]:
+    # every scenario of a group narrows the same data sets, so their slice of the cube is cut once
+    from calc import ALL_VALUE, filter_data
+    from cube import load_cube
+    from engine import dashboard_figures, dashboard_frames
+    from execution import collect
+
+    cube = load_cube()
+    base = collect(filter_data(data_set_list, ALL_VALUE, ALL_VALUE, ALL_VALUE, data=cube.lazy()), cube.estimated_size())
+    rows = []
+    for index, scenario in scenarios:
+        started = time.perf_counter()
+        figures = dashboard_figures(dashboard_frames(filter_data(**scenario, data=base.lazy()), filters=scenario))
+        name = scenario_name(scenario)
+        path = out_dir / 'reports' / f'{index:04d}-{slug(name)}.html'
+        render_report(path, scenario, figures['kpis'], figures, include_plotlyjs)
+        rows.append({
+            'scenario': index,
+            'name': name,
+            **scenario_columns(scenario),
+            **{key: value[0] for key, value in figures['kpis'].items()},
+            'report': str(path.relative_to(out_dir)),
+            'seconds': time.perf_counter() - started,
+        })
+    return rows
+
+
+# ---- batch ----------------------------------------------------------------------------------
+
+def run_batch(scenarios: list[dict], out_dir: Path, workers: int, memory_limit_mb: int | None,
+              plotlyjs: str = 'directory') -> pl.DataFrame:
+    from cube import load_cube
+    from ingest import ingest
+
+    # publish the store and cube once up front; the workers only map the cube file
+    ingest()
+    load_cube()
+    (out_dir / 'reports').mkdir(parents=True, exist_ok=True)
+    include_plotlyjs = {'directory': 'plotly.min.js', 'cdn': 'cdn', 'inline': True}[plotlyjs]
+    if plotlyjs == 'directory':
+        from plotly.offline import get_plotlyjs
+        (out_dir / 'reports' / 'plotly.min.js').write_text(get_plotlyjs())
+
+    groups = {}
+    for index, scenario in enumerate(scenarios):
+        key = tuple(scenario['data_set_list']) if scenario['data_set_list'] else None
+        groups.setdefault(key, []).append((index, scenario))
+    workers = max(1, min(workers, len(groups)))
+    # split the cores between the workers instead of every worker sizing polars' pool to all of them
+    os.environ.setdefault('POLARS_MAX_THREADS', str(max(1, (os.cpu_count() or 1) // workers)))
+    limit = memory_limit_mb * 1024 ** 2 if memory_limit_mb else None
+
+    rows, failures = [], []
+    # spawn, not fork: polars' thread pool doesn't survive a fork
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=limit_memory, initargs=(limit,)) as pool:
+        futures = {pool.submit(run_group, list(key) if key else None, members, out_dir, include_plotlyjs): key
+                   for key, members in groups.items()}
+        for future in as_completed(futures):
+            try:
+                rows.extend(future.result())
+            except Exception as error:
+                failures.append(f'{futures[future] or "All data sets"}: {error!r}')
+    for failure in failures:
+        print(f'failed: {failure}', file=sys.stderr)
+    kpis = pl.DataFrame(rows, schema_overrides=SCENARIO_SCHEMA).sort('scenario') if rows else pl.DataFrame()
+    kpis.write_csv(out_dir / 'kpis.csv')
+    kpis.write_parquet(out_dir / 'kpis.parquet')
+    if failures:
+        raise SystemExit(1)
+    return kpis
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write HTML reports and KPI tables for a grid of filter scenarios.')
+    parser.add_argument('--out', type=Path, default=Path('reports'))
+    parser.add_argument('--scenarios', type=Path, help='JSON list of filter states (filter_data arguments) '
+                                                       'instead of the grid below')
+    parser.add_argument('--datasets', choices=['each', 'all', 'both'], default='each',
+                        help='one scenario per data set, all data sets together, or both')
+    parser.add_argument('--affiliated', nargs='+', type=toggle, default=['All', True, False])
+    parser.add_argument('--specialty', nargs='+', type=toggle, default=['All', True, False])
+    parser.add_argument('--ftc', nargs='+', type=toggle, default=['All'])
+    parser.add_argument('--start', default='2023-01-01')
+    parser.add_argument('--end', default='2024-12-31')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--memory-limit-mb', type=int, help='address-space limit per worker process')
+    parser.add_argument('--plotlyjs', choices=['directory', 'cdn', 'inline'], default='directory',
+                        help='ship plotly.js once next to the reports, load it from the CDN, or embed it in each')
+    args = parser.parse_args()
+
+    if args.scenarios:
+        scenarios = load_scenarios(args.scenarios)
+    else:
+        from calc import get_files
+        datasets = {'each': [[file] for file in get_files()], 'all': [None],
+                    'both': [[file] for file in get_files()] + [None]}[args.datasets]
+        scenarios = scenario_grid(datasets, args.affiliated, args.specialty, args.ftc, args.start, args.end)
+    started = time.perf_counter()
+    kpis = run_batch(scenarios, args.out, args.workers, args.memory_limit_mb, args.plotlyjs)
+    print(f'{kpis.height} reports in {time.perf_counter() - started:.1f}s, KPIs in {args.out / "kpis.csv"}')
@@ -0,0 +1,147 @@
+from config import *
+from statistics import NormalDist
+from urllib.parse import quote
+import math
+import polars as pl
+from polars import col as c
+from calc import file_lock, filter_predicate, get_files, load_files, mc_diff
+from execution import collect, source_bytes
+
+SAMPLE_LOCK = CACHE_DIR / 'sample.lock'
+
+# strata of the sample: every data set is sampled on its own, per drug class and month, with the rows above
+# SAMPLE_CERTAINTY_QUANTILE in strata of their own
+SAMPLE_STRATA = ['dataset', 'drug_class', 'dos', 'certain']
+SAMPLE_COLUMNS = ['dataset', 'affiliated', 'is_special', 'is_ftc', 'drug_class', 'generic_name', 'dos',
+                  'total', 'mc_total', 'rx_ct']
+ESTIMATED = ['total', 'mc_total', 'rx_ct', 'mc_diff']
+# ratio KPIs: (numerator, denominator) of estimated totals
+RATIOS = {'per_rx': ('mc_diff', 'rx_ct'), 'diff_pct': ('mc_diff', 'total')}
+
+
+def sample_path(file: str) -> Path:
+    return SAMPLE_DIR / f'{quote(file, safe="")}.parquet'
+
+
+def sample_size() -> pl.Expr:
+    # the few largest charges decide most of the variance of a total, so their strata are kept whole
+    share = pl.max_horizontal(pl.lit(SAMPLE_STRATUM_MIN, pl.UInt32), (c.stratum_rows * SAMPLE_FRACTION).ceil().cast(pl.UInt32))
+    return pl.when(c.certain).then(c.stratum_rows).otherwise(pl.min_horizontal(c.stratum_rows, share))
+
+
+def draw_sample(file: str) -> int:
+    # drawn from the data set's store partitions, or its source file if it isn't ingested: a fixed share
+    # of every stratum picked at random, each row carrying its stratum's size and its weight N_h / n_h.
+    # Names are kept as strings, since the samples of data sets ingested against different dictionaries
+    # are read side by side.
+    sample = collect(
+        load_files([file])
+        .select(SAMPLE_COLUMNS)
+        .with_columns((c.total >= c.total.quantile(SAMPLE_CERTAINTY_QUANTILE)).alias('certain'))
+        .with_columns(pl.len().over(SAMPLE_STRATA).alias('stratum_rows'))
+        .with_columns(sample_size().alias('stratum_sample'))
+        # one random order over all rows, ranked within each stratum: shuffling per stratum would repeat
+        # the same permutation in strata of equal size, and the store's sort order would correlate them
+        .with_columns(pl.int_range(pl.len()).shuffle(SAMPLE_SEED).alias('draw'))
+        .filter(c.draw.rank('ordinal').over(SAMPLE_STRATA) <= c.stratum_sample)
+        .with_columns(c.drug_class.cast(pl.String), c.generic_name.cast(pl.String),
+                      (c.stratum_rows / c.stratum_sample).alias('weight'))
+        .drop('draw'),
+        source_bytes([file]),
+    )
+    SAMPLE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = sample_path(file).with_suffix('.tmp')
+    sample.write_parquet(tmp)
+    tmp.replace(sample_path(file))
+    return sample.height
+
+
+def write_sample(file: str) -> int:
+    with file_lock(SAMPLE_LOCK):
+        return draw_sample(file)
+
+
+def sample_current(file: str) -> bool:
+    # a sample drawn before its source file last changed is as good as missing
+    try:
+        return sample_path(file).stat().st_mtime_ns >= (DATA_DIR / f'{file}.parquet').stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def ensure_sample(file: str):
+    # ingest draws the samples, but the dev server runs without it: whatever it finds missing is drawn on
+    # first use, as the cube is built on a cold start
+    if not sample_current(file):
+        with file_lock(SAMPLE_LOCK):
+            if not sample_current(file):
+                draw_sample(file)
+
+
+def remove_sample(file: str):
+    sample_path(file).unlink(missing_ok=True)
+
+
+_samples = {}
+
+
+def load_sample(files: list[str]) -> pl.DataFrame | None:
+    # kept in memory per data set until its file is rewritten; None only if a data set can't be sampled
+    frames = []
+    for file in files:
+        try:
+            ensure_sample(file)
+            mtime = sample_path(file).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = _samples.get(file)
+        if cached is None or cached[0] != mtime:
+            cached = _samples[file] = (mtime, pl.read_parquet(sample_path(file)))
+        frames.append(cached[1])
+    return pl.concat(frames) if frames else None
+
+
+def stratified_variance(values: pl.DataFrame, columns: list[str]) -> dict:
+    # variance of the weighted totals of `columns` under stratified random sampling without replacement:
+    # sum over strata of N_h^2 (1 - n_h/N_h) s_h^2 / n_h
+    return (
+        values
+        .group_by(SAMPLE_STRATA)
+        .agg(c.stratum_rows.first(), c.stratum_sample.first(), *[c(column).var() for column in columns])
+        .select([(c(column).fill_null(0) * c.stratum_rows.cast(pl.Float64) ** 2
+                  * (1 - c.stratum_sample / c.stratum_rows) / c.stratum_sample).sum() for column in columns])
+        .row(0, named=True)
+    )
+
+
+def estimate_kpis(**filters) -> dict | None:
+    # the dashboard's KPIs estimated from the sample, each as (estimate, half-width of its confidence
+    # interval). Rows outside the filter state count as zeros rather than being dropped, so the state
+    # needn't line up with the strata. Ratios use the linearized variance of numerator - R * denominator.
+    # None when there is no sample, or too few of its rows match the state for the interval to mean
+    # anything (a rare drug may not be in it at all).
+    sample = load_sample(filters.get('data_set_list') or get_files())
+    if sample is None:
+        return None
+    matched = filter_predicate(**filters)
+    if sample.select(matched.sum()).item() < SAMPLE_MIN_MATCHED:
+        return None
+    values = (
+        sample
+        .select(*SAMPLE_STRATA, 'stratum_rows', 'stratum_sample', 'weight',
+                *[pl.when(matched).then(c(measure).cast(pl.Float64)).otherwise(0.0).alias(measure)
+                  for measure in ('total', 'mc_total', 'rx_ct')])
+        .with_columns(mc_diff())
+    )
+    totals = values.select([(c(column) * c.weight).sum() for column in ESTIMATED]).row(0, named=True)
+    ratios = {name: totals[top] / totals[bottom] if totals[bottom] else math.nan
+              for name, (top, bottom) in RATIOS.items()}
+    values = values.with_columns([(c(top) - (ratios[name] if totals[bottom] else 0) * c(bottom)).alias(name)
+                                  for name, (top, bottom) in RATIOS.items()])
+    variance = stratified_variance(values, ESTIMATED + list(RATIOS))
+    z = NormalDist().inv_cdf(0.5 + SAMPLE_CONFIDENCE / 2)
+    estimates = {column: (totals[column], z * math.sqrt(variance[column])) for column in ESTIMATED}
+    for name, (top, bottom) in RATIOS.items():
+        margin = z * math.sqrt(variance[name]) / abs(totals[bottom]) if totals[bottom] else math.nan
+        estimates[name] = (ratios[name], margin)
+    return estimates
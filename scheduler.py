@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import *
+import contextvars
+import threading
+import uuid
+from metrics import Counter, Gauge, register
+
+SCHEDULER_JOBS = register(Counter('scheduler_jobs_total', 'Scheduled callback work by outcome.'))
+
+
+class Superseded(Exception):
+    # every session waiting on the job has moved on to a newer filter state
+    pass
+
+
+class Job:
+    def __init__(self, key: str):
+        self.key = key
+        self.tickets = []
+        self.future = None
+
+
+class Scheduler:
+    # runs callback work on a bounded pool. Identical work (same lane and filter key) from any number
+    # of sessions runs once; work whose sessions have all issued a newer request in the same lane is
+    # dropped at its next checkpoint instead of running to completion.
+    def __init__(self, workers: int = SCHEDULER_WORKERS, max_sessions: int = SCHEDULER_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='mc-query')
+        self._latest = OrderedDict()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def queued(self) -> int:
+        return self.pool._work_queue.qsize()
+
+    def _ticket(self, session: str | None, lane: str) -> tuple:
+        # requests without a session can't be superseded; each gets a lane of its own
+        slot = (session or uuid.uuid4().hex, lane)
+        generation = self._latest.pop(slot, 0) + 1
+        self._latest[slot] = generation
+        while len(self._latest) > self.max_sessions:
+            self._latest.popitem(last=False)
+        return slot, generation
+
+    def _live(self, job: Job) -> bool:
+        return any(self._latest.get(slot) == generation for slot, generation in job.tickets)
+
+    def _checkpoint(self, job: Job):
+        with self._lock:
+            if not self._live(job):
+                self._jobs.pop(job.key, None)
+                raise Superseded
+
+    def _execute(self, job: Job, work):
+        try:
+            self._checkpoint(job)
+            return work(lambda: self._checkpoint(job))
+        finally:
+            with self._lock:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    def run(self, session: str | None, lane: str, key: str, work):
+        # `work` receives a checkpoint callable to call between its expensive steps; raises Superseded
+        # when the result is no longer wanted by anyone
+        with self._lock:
+            ticket = self._ticket(session, lane)
+            job_key = f'{lane}:{key}'
+            job = self._jobs.get(job_key)
+            if job is None:
+                job = self._jobs[job_key] = Job(job_key)
+                job.tickets.append(ticket)
+                # the caller's context carries the callback's metrics
+                job.future = self.pool.submit(contextvars.copy_context().run, self._execute, job, work)
+                outcome = 'run'
+            else:
+                job.tickets.append(ticket)
+                outcome = 'coalesced'
+        try:
+            result = job.future.result()
+        except Superseded:
+            SCHEDULER_JOBS.inc(outcome='superseded')
+            raise
+        SCHEDULER_JOBS.inc(outcome=outcome)
+        return result
+
+
+SCHEDULER = Scheduler()
+register(Gauge('scheduler_queued_jobs', 'Callback work waiting for a pool thread.', SCHEDULER.queued))
@@ -0,0 +1,62 @@
+from config import *
+from contextlib import contextmanager
+import logging
+import time
+from metrics import Counter, register
+
+logger = logging.getLogger('mc.startup')
+
+STARTUP_SECONDS = register(Counter('startup_phase_seconds', 'Time spent in each phase of process startup.'))
+PHASES = {}
+
+
+def record_phase(name: str, seconds: float):
+    PHASES[name] = PHASES.get(name, 0) + seconds
+    STARTUP_SECONDS.inc(seconds, phase=name)
+
+
+@contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def startup_report() -> dict:
+    return {'seconds': sum(PHASES.values()), 'phases': dict(PHASES)}
+
+
+def log_startup():
+    report = startup_report()
+    logger.info('started in %.2fs (%s)', report['seconds'],
+                ', '.join(f'{name} {seconds:.2f}s' for name, seconds in report['phases'].items()))
+
+
+def default_filters() -> dict:
+    # the filter state a fresh page load asks for first
+    return dict(data_set_list=None, affiliated_group='All', specialty_group='All', ftc_group='All',
+                drug_class_list=None, drug_name_list=None, date_start=DEFAULT_DATE_START, date_end=DEFAULT_DATE_END)
+
+
+def warm_up(client_crossfilter: bool = False):
+    # renders the default view into the figure cache (and the frame cache under it) and builds the facet
+    # index, so the first user after a deploy or a scale-up doesn't pay for the cold queries
+    from cube import data_version
+    from query import filter_key
+
+    filters = default_filters()
+    if client_crossfilter:
+        from crossfilter import crossfilter_view, slice_filters
+        crossfilter_view(slice_filters(None, DEFAULT_DATE_START, DEFAULT_DATE_END))
+        return
+    from engine import dashboard_view, view_etag
+    from facets import facet_options
+    dashboard_view(view_etag(data_version(), filter_key(**filters)), filters)
+    if PROGRESSIVE_MODE:
+        from calc import get_files
+        from sampling import load_sample
+        load_sample(get_files())
+    facet_options('drug_class', **{arg: value for arg, value in filters.items() if arg != 'drug_class_list'})
+    facet_options('generic_name', **{arg: value for arg, value in filters.items() if arg != 'drug_name_list'})
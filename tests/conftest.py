@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# the modules are flat at the repository root and config's data and cache paths are relative to it
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
@@ -0,0 +1,75 @@
+import pytest
+from flask import Flask
+from api import register_api
+
+
+@pytest.fixture(scope='module')
+def client():
+    # the API alone on a bare Flask app, without the Dash dashboard around it
+    server = Flask(__name__)
+    register_api(server)
+    return server.test_client()
+
+
+def error_of(response) -> str:
+    assert response.status_code == 400
+    return response.get_json()['error']
+
+
+def test_unknown_parameter(client):
+    assert 'unknown parameters: affiliated' in error_of(client.post('/api/kpis', json={'affiliated': True}))
+
+
+@pytest.mark.parametrize('value', ['maybe', 'yes', 1])
+def test_bad_toggle(client, value):
+    assert 'affiliated_group must be' in error_of(client.post('/api/kpis', json={'affiliated_group': value}))
+
+
+def test_bad_toggle_query_parameter(client):
+    assert 'ftc_group must be' in error_of(client.get('/api/kpis?ftc_group=maybe'))
+
+
+@pytest.mark.parametrize('spec', [{'date_start': '2023-01-01'}, {'date_end': '2023-12-31'}])
+def test_half_open_date_range(client, spec):
+    assert 'given together' in error_of(client.post('/api/kpis', json=spec))
+
+
+@pytest.mark.parametrize('start, end', [(20230101, 20231231), ('20230101', '20231231'), ('2023-02-30', '2023-03-31'),
+                                        (['2023-01-01'], '2023-12-31')])
+def test_bad_date(client, start, end):
+    assert 'date_start must be an ISO date' in error_of(client.post('/api/kpis', json={'date_start': start,
+                                                                                     'date_end': end}))
+
+
+@pytest.mark.parametrize('spec', [{'data_set_list': [1, 2]}, {'drug_name_list': [5]}, {'drug_class_list': [None]},
+                                  {'drug_class_list': ['']}, {'data_set_list': 'MCCPDC Employer Reprices'}])
+def test_bad_list(client, spec):
+    assert 'must be a list' in error_of(client.post('/api/kpis', json=spec))
+
+
+def test_one_bad_scenario_fails_the_batch(client):
+    body = {'scenarios': [{'id': 'ok'}, {'id': 'bad', 'affiliated_group': 'maybe'}]}
+    assert 'affiliated_group' in error_of(client.post('/api/kpis', json=body))
+
+
+def test_kpis(client):
+    body = {'scenarios': [{'id': 'all'}, {'id': 'affiliated', 'affiliated_group': True,
+                                          'date_start': '2023-01-01', 'date_end': '2024-12-31'}]}
+    response = client.post('/api/kpis', json=body)
+    assert response.status_code == 200
+    everything, affiliated = response.get_json()['results']
+    assert [everything['id'], affiliated['id']] == ['all', 'affiliated']
+    assert 0 < affiliated['total'] < everything['total']
+    assert affiliated['mc_diff'] == pytest.approx(affiliated['total'] - affiliated['mc_total'])
+
+
+def test_etag_not_modified(client):
+    url = '/api/kpis?affiliated_group=true&date_start=2023-01-01&date_end=2024-06-30'
+    first = client.get(url)
+    assert first.status_code == 200 and first.headers['ETag']
+    again = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert again.data == b''
+    # a different scenario is a different answer
+    other = client.get(url.replace('true', 'false'), headers={'If-None-Match': first.headers['ETag']})
+    assert other.status_code == 200